@@ -3,18 +3,55 @@ import glob
 import pytz
 import datetime
 import time
-from win32com.propsys import propsys, pscon
 import argparse
 import sys
+import stat
+import errno
 import re
+import math
+import random
+import threading
+import contextlib
+import contextvars
+import asyncio
+import concurrent.futures
+import queue
+import heapq
+import itertools
+import pickle
+import tempfile
+import collections
+import array
+import zlib
+import sqlite3
+import string
 import hashlib 
 import exifread
-from pathlib import Path
 import shutil
+import subprocess
 import csv
+import io
+import zipfile
+import tarfile
 from dateutil.parser import parse
 import json
 from dictor import dictor
+try:
+  import psutil
+except ImportError:
+  psutil = None
+try:
+  import numpy
+except ImportError:
+  numpy = None
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+try:
+  from win32com.propsys import propsys, pscon
+except ImportError:
+  propsys = pscon = None
 
 # **************************************************
 # default settings
@@ -44,8 +81,175 @@ def get_defaults():
     "resultsuse":"",
     "number":0,
     "jsonextensions":"",
+    "iothreads":1,
+    "shard":None,
+    "shardby":"hash",
+    "resultsmerge":[],
+    "catalog":"",
+    "catalogrefresh":False,
+    "iolimit":[],
+    "ioidle":False,
+    "ioadaptive":False,
+    "dirfds":256,
+    "archives":False,
+    "estimate":0,
+    "walkthreads":8,
+    "extractorstate":"",
+    "pipeline":0,
+    "link":"",
+    "simulate":"",
+    "sortbuffer":200000,
   }
 
+#  --------
+#  loglevels CONSTANTS
+loglevels = ["silent","critical","error","warning",
+        "info","verbose","allmsg"]
+silent = 0
+critical = 1
+error = 2
+warning = 3
+info = 4
+verbose = 5
+allmsg = 6
+
+#  ********
+#  an error that stops a run. raised instead of exiting
+#  so an engine can be used from other code, the 
+#  command line exits on it
+class Mf2fsError(Exception):
+  pass
+
+#  ********
+#  the state of a run: the settings, the prefix of the
+#  csv files, the extension tables, the folder patterns,
+#  the catalog and the caches. every engine has its 
+#  own state, the command line uses the default state
+class RunState:
+
+  def __init__(self, settings: dict = None, now: str = None):
+
+    self.settings = settings if settings is not None \
+                      else get_defaults()
+    self.now = now or datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    self.extlodext, self.catlst = [], []
+    self.targetPatterns = {}
+    self.catalog = None
+    self.throttle = None
+    self.dirfds = DirFds(0)
+    self.searchStats = SearchStats()
+    self.extensionClasses = {}
+    self.extractors = ExtractorStats()
+    self.linkedFiles = {}
+    self.folderDevices = {}
+    self.memberDigests = {}
+
+  #  ********
+  #  the state of the caller (and the threads it starts)
+  @contextlib.contextmanager
+  def bound(self):
+
+    token = runState.set(self)
+    try:
+      yield self
+    finally:
+      runState.reset(token)
+
+# state of the running engine, per context (thread or
+# task), new threads are given the state of their
+# starter (initializer or withState)
+runState = contextvars.ContextVar("runState")
+defaultState = None
+
+def currentState() -> RunState:
+
+  global defaultState
+
+  state = runState.get(None)
+  if state is None:
+    if defaultState is None:
+      defaultState = RunState()
+    state = defaultState
+  return state
+
+#  ********
+#  function for a new thread, it runs with the state
+#  of the caller (threads do not inherit the context)
+def withState(function):
+
+  state = currentState()
+
+  def run(*args, **kwargs):
+    runState.set(state)
+    return function(*args, **kwargs)
+  return run
+
+#  ********
+#  module name for a part of the state of the running
+#  engine (settings, catalog, dirfds, ...), the 
+#  functions of this script use these names
+class StateProxy:
+
+  __slots__ = ("_name",)
+
+  def __init__(self, name: str):
+    object.__setattr__(self, "_name", name)
+
+  def _target(self):
+    return getattr(currentState(), self._name)
+
+  def __getattr__(self, name):
+    return getattr(self._target(), name)
+
+  def __setattr__(self, name, value):
+    setattr(self._target(), name, value)
+
+  def __getitem__(self, key):
+    return self._target()[key]
+
+  def __setitem__(self, key, value):
+    self._target()[key] = value
+
+  def __delitem__(self, key):
+    del self._target()[key]
+
+  def __contains__(self, key):
+    return key in self._target()
+
+  def __iter__(self):
+    return iter(self._target())
+
+  def __len__(self):
+    return len(self._target())
+
+  def __bool__(self):
+    return bool(self._target())
+
+  def __eq__(self, other):
+    return self._target() == other
+
+  def __hash__(self):
+    return hash(self._target())
+
+  def __add__(self, other):
+    return self._target() + other
+
+  def __radd__(self, other):
+    return other + self._target()
+
+  def __str__(self):
+    return str(self._target())
+
+  def __repr__(self):
+    return repr(self._target())
+
+  def __format__(self, spec):
+    return format(self._target(), spec)
+
+# the settings and the prefix of the csv files of
+# the running engine (or the command line)
+settings = StateProxy("settings")
+now = StateProxy("now")
 
 # **************************************************
 # print string to screen for user feedback
@@ -92,7 +296,7 @@ def p(plevel:int, text, *args) -> bool:
 
 #  ********
 #  main function
-def initialize():
+def initialize(argv=None):
  
   # doc: https://docs.python.org/3/library/argparse.html
   parser = argparse.ArgumentParser(
@@ -158,8 +362,11 @@ def initialize():
     default="ymd_structure",
     nargs="?",
     help="Pattern to use when defining the destination folder \
-      for verification of files from source folder \
-      (not implemented yet).",
+      for verification of files from source folder. Either a \
+      structure name (ymd_structure, ym_structure, y_structure, \
+      yw_structure) or a template using the fields {year}, \
+      {month}, {day}, {isoyear}, {isoweek}, {category} and \
+      {extension}, e.g. '{category}/{year}'.",
   )
   parser.add_argument(
     "--target",
@@ -239,6 +446,190 @@ def initialize():
       perform actions. Takes file prefix as a parameter in \
       the form YYYYMMDD_HHMMSS.",
   )
+  parser.add_argument(
+    "--iothreads",
+    metavar='',
+    type=int,
+    dest="iothreads",
+    default=1,
+    nargs="?",
+    help="Number of concurrent reads (hash, exif, copy) per \
+      device. Work is grouped per device and ordered by inode.",
+  )
+  parser.add_argument(
+    "--shard",
+    metavar='',
+    type=shardArgument,
+    dest="shard",
+    default=None,
+    nargs="?",
+    help="Only handle shard i of N (in the form i/N) of the \
+      input folder. Results are saved with the prefix \
+      YYYYMMDD_HHMMSS_shardIofN.",
+  )
+  parser.add_argument(
+    "--shardby",
+    metavar='',
+    dest="shardby",
+    default="hash",
+    choices=["hash", "subtree"],
+    nargs="?",
+    help="Partition the input folder on the hash of the file \
+      path (hash, default) or per top level folder (subtree).",
+  )
+  parser.add_argument(
+    "--merge",
+    metavar='',
+    dest="resultsmerge",
+    default=[],
+    nargs="+",
+    help="Merge the results of sharded runs, takes the file \
+      prefixes. Saves one result set to be used with \
+      --useresults and reports target collisions.",
+  )
+  parser.add_argument(
+    "--catalog",
+    metavar='',
+    dest="catalog",
+    default="",
+    const="default",
+    nargs="?",
+    help="Keep a catalog (sqlite) of the files in the target \
+      folder by content hash, files already archived under \
+      another path are reported and not moved. Optionally \
+      takes the catalog file, default is .mf2fs_catalog.db \
+      in the target folder.",
+  )
+  parser.add_argument(
+    "--catalogrefresh",
+    dest="catalogrefresh",
+    default=False,
+    action="store_true",
+    help="Walk the target folder and update the catalog for \
+      new, changed (size/mtime) and removed files.",
+  )
+  parser.add_argument(
+    "--iolimit",
+    metavar='',
+    dest="iolimit",
+    default=[],
+    nargs="+",
+    help="Limit bytes and file operations per second per \
+      device, in the form bytes=20M,ops=100 for all devices \
+      or bytes=5M,ops=50@path for the device of path.",
+  )
+  parser.add_argument(
+    "--ioadaptive",
+    dest="ioadaptive",
+    default=False,
+    action="store_true",
+    help="Back off when the observed latency of a device \
+      spikes above its baseline.",
+  )
+  parser.add_argument(
+    "--ioidle",
+    dest="ioidle",
+    default=False,
+    action="store_true",
+    help="Run with idle I/O priority.",
+  )
+  parser.add_argument(
+    "--walkthreads",
+    metavar='',
+    dest="walkthreads",
+    default=8,
+    type=int,
+    help="Number of folders listed concurrently, default 8.",
+  )
+  parser.add_argument(
+    "--sortbuffer",
+    metavar='',
+    dest="sortbuffer",
+    default=200000,
+    type=int,
+    help="Renames kept in memory while sorting the plan on target \
+      folder, more are sorted in runs on disk, default 200000.",
+  )
+  parser.add_argument(
+    "--simulate",
+    metavar='',
+    dest="simulate",
+    default="",
+    help="Run against a simulated slow or unreliable file system \
+      (for measuring and testing), in the form latency=20ms,\
+      jitter=10ms,errors=0.001,errno=EIO+EXDEV+ENOSPC,seed=1.",
+  )
+  parser.add_argument(
+    "--dirfds",
+    metavar='',
+    type=int,
+    dest="dirfds",
+    default=256,
+    nargs="?",
+    help="Number of open directories to keep for directory \
+      relative file operations, 0 uses full paths.",
+  )
+  parser.add_argument(
+    "--extractorstate",
+    metavar='',
+    dest="extractorstate",
+    default="",
+    const="default",
+    nargs="?",
+    help="Keep the success of the date extractors (exif, filename)\
+      per extension between runs. Extractors that never yield a\
+      date for an extension are skipped, with an occasional \
+      re-probe. Optionally takes the file, default is \
+      .mf2fs_extractors.json in the target folder.",
+  )
+  parser.add_argument(
+    "--archives",
+    dest="archives",
+    default=False,
+    action="store_true",
+    help="Index the members of zip and tar archives as streams \
+      and write media members directly into the target \
+      structure.",
+  )
+  parser.add_argument(
+    "--link",
+    metavar='',
+    dest="link",
+    default="",
+    const="hard",
+    nargs="?",
+    choices=["hard", "reflink"],
+    help="Link files into the target structure instead of \
+      renaming (moving) them, the source stays in place. \
+      Optionally hard (default) or reflink. When linking is \
+      not possible (another filesystem) the file is copied.",
+  )
+  parser.add_argument(
+    "--pipeline",
+    metavar='',
+    dest="pipeline",
+    default=0,
+    const=256,
+    nargs="?",
+    type=int,
+    help="Overlap the search, the check and the actions, files \
+      are moved while the search is still running. Optionally \
+      takes the size of the queues between the stages, default \
+      256.",
+  )
+  parser.add_argument(
+    "--estimate",
+    metavar='',
+    dest="estimate",
+    default=0,
+    const=0.1,
+    nargs="?",
+    type=float,
+    help="Estimate files, bytes to move, duplicates and runtime \
+      of a full run from a sample per extension, nothing is \
+      moved. Optionally takes the margin of error of the \
+      sample, default 0.1.",
+  )
   parser.add_argument(
     "--number",
     "-n",
@@ -249,301 +640,2350 @@ def initialize():
     help="Maximum files to evaluate (steps of 50).",
   )
 
-  global settings
-  global silent
-  global critical
-  global error
-  global warning
-  global info
-  global verbose
-  global allmsg
-  global searchResults
-
-  options = vars(parser.parse_args())
-  settings = get_defaults()
-  settings.update(options)
-  searchResults = list()
+  options = vars(parser.parse_args(argv))
+  state = currentState()
+  state.settings = get_defaults()
+  state.settings.update(options)
+  state.searchStats = SearchStats()
+  return state.settings
  
 
 #  ********
-#  delete file
-#  > returns True|False
-def deleteFiles(filelist) -> bool:
-
-  for files in filelist:
+#  lists folders concurrently, each thread takes the
+#  newest folder from its own queue (depth first) and
+#  when that is empty steals the oldest folder of 
+#  another thread. subfolders found go to the queue 
+#  of the thread that found them
+class TreeWalker:
+
+  def __init__(self, workers: int = 1):
+
+    self.workers = max(1, int(workers))
+    self.queues = [collections.deque() for i in range(self.workers)]
+    self.lock = threading.Lock()
+    # signalled when a folder is pushed or the walk is done
+    self.ready = threading.Condition(self.lock)
+    self.pending = 0
+    self.done = threading.Event()
+    self.results = queue.Queue(maxsize=self.workers * 64)
+
+  #  ********
+  #  folder to list, recurse into its subfolders or not
+  def push(self, worker: int, path: str, recurse: bool = True):
+
+    with self.ready:
+      self.pending += 1
+      self.queues[worker].append((path, recurse))
+      self.ready.notify()
+
+  #  ********
+  #  > returns (path, recurse) or None, called with 
+  #  the lock held
+  def take(self, worker: int):
 
     try:
-      os.remove(files[0]) 
+      return self.queues[worker].pop()
+    except IndexError:
+      pass
+    for i in range(1, self.workers):
+      try:
+        return self.queues[(worker + i) % self.workers].popleft()
+      except IndexError:
+        pass
+    return None
 
-    except IsADirectoryError as i:
-      p(warning, 'Removing a directory', files[0]
-           , 'is not supported, error ', i)
+  #  ********
+  #  thread, list folders until all are listed
+  def work(self, worker: int):
 
-    except Exception as e:
-      p(error, 'Deleting file', files[0], 'failed with error', 
-           e, 'Do you have sufficient rights?')
+    while True:
+      with self.ready:
+        item = None
+        while not self.done.is_set():
+          item = self.take(worker)
+          if item is not None:
+            break
+          self.ready.wait()
+      if item is None:
+        return
 
-  return True
+      path, recurse = item
+      p(allmsg, path)
+      files = []
+      try:
+        for entry in dirfds.scandir(path):
+          if entry.is_dir():
+            if recurse:
+              self.push(worker, entry.path)
+          elif entry.is_file():
+            files.append(entry)
+      except Exception as e:
+        p(error, e)
 
-#  ********
-#  rename file
-#  > returns True|False
-def renameTheFiles(filelist: list) -> bool:
+      while not self.done.is_set():
+        try:
+          self.results.put((path, files), timeout=0.1)
+          break
+        except queue.Full:
+          pass
 
-  global deleteSourceFile
+      with self.ready:
+        self.pending -= 1
+        if self.pending == 0:
+          self.done.set()
+          self.ready.notify_all()
 
-  n=0
-  t=1
-  for files in filelist:
-    if n == 0 or n==50:
-      p(warning,'Renaming (or copying) files from  files list'
-        , t, 'of', len(filelist))
-      n=0
-    n+=1
-    if files[0][:1] == files[1][:1]: 
-      try:
-        os.rename(os.path.join(files[0]), os.path.join(files[1])) 
-      except WindowsError as w:
-        p(error, 'File', files[0], 'gives me a message while \
-              renaming', w)
-      except Exception as e:
-        p(error, 'Renaming file', os.path.join(files[0])
-             , 'to', os.path.join(files[1])
-             , 'failed with error', e
-             , 'Do you have sufficient rights?')
+  #  ********
+  #  roots = [(path, recurse), ...]
+  #  > yields (folder, [DirEntry of files])
+  def walk(self, roots):
 
-    else:
+    for i, (path, recurse) in enumerate(roots):
+      self.push(i % self.workers, path, recurse)
+    if not self.pending:
+      return
+
+    threads = [threading.Thread(target=withState(self.work), args=(i,), 
+                                daemon=True)
+               for i in range(self.workers)]
+    for thread in threads:
+      thread.start()
+
+    try:
+      while True:
+        try:
+          yield self.results.get(timeout=0.05)
+        except queue.Empty:
+          if self.done.is_set() and self.results.empty():
+            break
+    finally:
+      # also when the caller stops early (--number)
+      with self.ready:
+        self.done.set()
+        self.ready.notify_all()
+      for thread in threads:
+        thread.join()
+
+#  ********
+#  device aware scheduler, work is grouped per device
+#  (st_dev of the folder, or the drive when st_dev is 
+#  not known) and ordered by inode within a device as
+#  a proxy for the on-disk locality. every device has
+#  its own long-lived worker threads fed by a bounded
+#  queue, so a slow device does not stall a fast one.
+#  items are read and sorted a window at a time by a
+#  feeder thread, so only a window of items per device
+#  is held at a time
+class DeviceScheduler:
+
+  # items grouped and sorted at a time, and the items
+  # queued per device
+  window = 4096
+
+  def __init__(self, perdevice: int = 1, path=None):
+
+    self.perdevice = max(1, int(perdevice or 1))
+    # function returning the path for an item, DirEntry
+    # objects and path strings are handled by default
+    self.path = path
+    self.devices = set()
+
+  #  ********
+  #  > returns (device, inode) for an item, the device
+  #  is taken once per folder. the inode is only known
+  #  for a DirEntry (from the listing), other items 
+  #  keep their order
+  def locate(self, item):
+
+    if self.path is None and isinstance(item, os.DirEntry):
+      filepath = item.path
       try:
-        shutil.copy2(files[0], files[1])
-        if os.path.isfile(files[1]):
-          if settings["sourcedelete"]:
-            deleteFile = []
-            deleteFile.append(files)
-            deleteFiles(deleteFile)
-        else:
-          p(info, 'No erros but file doesn\'t exist. Bummer.')
-      except Exception as c:
-        p(error, 'This didn\'t work, sorry: ', c)
+        inode = item.inode()
+      except OSError:
+        inode = 0
+    else:
+      filepath = self.path(item) if self.path else item
+      inode = 0
+
+    return folderDevice(os.path.dirname(filepath)), inode
+
+  #  ********
+  #  > returns dict with a list of items per device
+  #  sorted on inode
+  def group(self, items) -> dict:
+
+    groups = {}
+    for item in items:
+      device, inode = self.locate(item)
+      groups.setdefault(device, []).append((inode, item))
+
+    for device in groups:
+      groups[device].sort(key=lambda x: x[0])
+      groups[device] = [x[1] for x in groups[device]]
+
+    self.devices.update(groups)
+    return groups
+
+  #  ********
+  #  run worker(item) for all items (any iterable, 
+  #  consumed a window at a time), results are yielded
+  #  in order of completion. the queues are bounded so
+  #  the feeder waits for the workers and the workers 
+  #  for the consumer, all threads end when the 
+  #  consumer stops early
+  def run(self, items, worker):
+
+    results = queue.Queue(maxsize=max(64, 4*self.perdevice))
+    stop = threading.Event()
+    done = object()
+    queues = {}
+    threads = []
+    failed = []
+
+    #  > returns False when stopped
+    def put(target, value) -> bool:
+      while not stop.is_set():
+        try:
+          target.put(value, timeout=0.1)
+          return True
+        except queue.Full:
+          pass
+      return False
 
-    t+=1
+    def work(device, todo):
+      while not stop.is_set():
+        try:
+          item = todo.get(timeout=0.1)
+        except queue.Empty:
+          continue
+        if item is done:
+          return
+        try:
+          result = worker(item)
+        except Exception as e:
+          p(error, 'Processing', item, 'on device', device,
+            'failed with error', e)
+          result = None
+        if not put(results, result):
+          return
+
+    def feed():
+      source = iter(items)
+      try:
+        while not stop.is_set():
+          groups = self.group(itertools.islice(source, self.window))
+          if not groups:
+            break
+          for device, todo in groups.items():
+            if device not in queues:
+              queues[device] = queue.Queue(maxsize=self.window)
+              for i in range(self.perdevice):
+                thread = threading.Thread(target=withState(work), 
+                                          args=(device, queues[device]),
+                                          daemon=True)
+                threads.append(thread)
+                thread.start()
+            for item in todo:
+              if not put(queues[device], item):
+                return
+      except BaseException as e:
+        failed.append(e)
+      finally:
+        # a generator (the walk) is closed by its thread
+        if hasattr(source, "close"):
+          source.close()
+        for todo in queues.values():
+          for i in range(self.perdevice):
+            put(todo, done)
+        for thread in threads:
+          thread.join()
+        put(results, done)
+
+    feeder = threading.Thread(target=withState(feed), daemon=True)
+    feeder.start()
+    try:
+      while True:
+        result = results.get()
+        if result is done:
+          break
+        yield result
+    finally:
+      stop.set()
+      feeder.join()
 
-  return True
+    if failed:
+      raise failed[0]
 
 #  ********
-#  write results to files
-def writeResultsToCsv(list: list, outputfile) -> bool:
-  try:
-    with open(outputfile, "w", newline="") as f:
-      writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_ALL)
-      writer.writerows(list)
-    f.close()
-    return True
-  except Exception as e:
-    p(error, 'Saving file', outputfile, 'with', len(list)
-         , 'records failed with error', e
-         , 'Do you have sufficient rights?')
-    return False
+#  local dates (int YYYYMMDD) of mtimes (ns), with numpy
+#  vectorised: the utc offset is taken once per distinct 
+#  quarter of an hour (zones differ by quarter hours, 
+#  e.g. the half hour America/St_Johns). a quarter in 
+#  which the offset changes (St_Johns changed at 00:01
+#  until 2011) is taken per file. the days are split 
+#  into year, month and day as datetime64
+def mtimeDates(mtimes):
+
+  if numpy is None:
+    return [int(datetime.datetime.fromtimestamp(
+                    mtime / 1e9).strftime('%Y%m%d'))
+            for mtime in mtimes]
+
+  seconds = numpy.asarray(mtimes, dtype=numpy.int64) // 1000000000
+  quarters, inverse = numpy.unique(seconds // 900, return_inverse=True)
+  inverse = inverse.ravel()
+  starts = numpy.array([time.localtime(int(quarter) * 900).tm_gmtoff 
+                        for quarter in quarters], dtype=numpy.int64)
+  ends = numpy.array([time.localtime(int(quarter) * 900 + 899).tm_gmtoff 
+                      for quarter in quarters], dtype=numpy.int64)
+  offsets = starts[inverse]
+  changed = numpy.nonzero((starts != ends)[inverse])[0]
+  if len(changed):
+    offsets[changed] = [time.localtime(int(second)).tm_gmtoff 
+                        for second in seconds[changed]]
+  days = ((seconds + offsets) // 86400
+            ).astype('datetime64[D]')
+  months = days.astype('datetime64[M]')
+  years = months.astype('datetime64[Y]').astype(numpy.int64) + 1970
+  return (years * 10000 + 
+          (months.astype(numpy.int64) % 12 + 1) * 100 +
+          (days - months.astype('datetime64[D]')).astype(numpy.int64) + 1)
+
 
 #  ********
-#  load results from files
-def loadResultsFromCsv(filename) -> list:
-  try:
-    with open(filename, "r", newline="") as f:
-      reader = csv.reader(f, delimiter='\t')
-      csvdata = list(reader)
-    f.close()
-    return csvdata
-  except Exception as e:
-    p(error, 'Loading results file', filename
-         , 'failed with error', e
-         , 'Do you have sufficient rights?')
-    return False
+#  records (as of processFile) without a date get the
+#  date of their mtime, with one mtimeDates for all of
+#  them. records without an mtime stay undated, as in
+#  fillDates
+#  > returns the records
+def dateRecords(records: list) -> list:
+
+  rows = [i for i, record in enumerate(records) 
+            if record[3] is None and record[8]]
+  if rows:
+    for i, date in zip(rows, mtimeDates([records[i][8] for i in rows])):
+      records[i] = records[i][:3] + (date,) + records[i][4:]
+  return records
 
 #  ********
-# remove duplicates from list
-def removeDuplicates(inlist)->list:
+#  compact columnar store for the file records of a
+#  run. directories (and the structure, category and
+#  extension names) are interned, dates are kept as
+#  YYYYMMDD integers and md5 digests as 16 raw bytes
+class FileStore:
+
+  __slots__ = ("strings", "stringIds", "dirs", "names", "dates",
+               "digests", "nodigest", "structs", "cats", "exts",
+               "sizes", "mtimes", "inodes")
+
+  def __init__(self):
+
+    self.strings = []
+    self.stringIds = {}
+    self.dirs = array.array('l')
+    self.names = []
+    self.dates = array.array('l')
+    self.digests = bytearray()
+    self.nodigest = bytearray()
+    self.structs = array.array('l')
+    self.cats = array.array('l')
+    self.exts = array.array('l')
+    self.sizes = array.array('q')
+    self.mtimes = array.array('q')
+    self.inodes = array.array('Q')
+
+  def __len__(self):
+    return len(self.names)
+
+  #  ********
+  #  > returns the id of an (interned) string
+  def intern(self, value) -> int:
+
+    value = '' if value is None else str(value)
+    try:
+      return self.stringIds[value]
+    except KeyError:
+      self.stringIds[value] = len(self.strings)
+      self.strings.append(value)
+      return self.stringIds[value]
+
+  #  ********
+  #  add a record (hashedvalue, filepath, filename, 
+  #  date, structure, category, extension, size, 
+  #  mtime_ns, inode)
+  #  > returns the row number
+  def append(self, record) -> int:
+
+    hashedvalue, filepath, filename, date, struct, cat, ext, \
+      size, mtime, inode = record
 
-  list_set = set(inlist)
-  unique_list = (list(list_set))
-  return unique_list
+    try:
+      digest = bytes.fromhex(hashedvalue)
+      if len(digest) != 16:
+        raise ValueError
+      self.nodigest.append(0)
+    except (TypeError, ValueError):
+      digest = bytes(16)
+      self.nodigest.append(1)
+    self.digests += digest
+
+    date = str(date)[0:8]
+    self.dates.append(int(date) if date.isdigit() else 0)
+
+    self.dirs.append(self.intern(os.path.dirname(filepath)))
+    self.names.append(filename)
+    self.structs.append(self.intern(struct))
+    self.cats.append(self.intern(cat))
+    self.exts.append(self.intern(ext))
+    self.sizes.append(-1 if size is None else size)
+    self.mtimes.append(mtime or 0)
+    self.inodes.append(inode or 0)
+
+    return len(self.names) - 1
+
+  #  ********
+  #  rows without a date get the date of their mtime,
+  #  for the whole store at once
+  #  > returns number of dates filled
+  def fillDates(self) -> int:
+
+    if numpy is not None:
+      dates = numpy.array(self.dates, dtype=numpy.int64)
+      mtimes = numpy.array(self.mtimes, dtype=numpy.int64)
+      rows = numpy.flatnonzero((dates == 0) & (mtimes != 0))
+      if len(rows):
+        dates[rows] = mtimeDates(mtimes[rows])
+        filled = array.array(self.dates.typecode)
+        filled.frombytes(
+              dates.astype(numpy.dtype(self.dates.typecode)).tobytes())
+        self.dates = filled
+      return len(rows)
+
+    rows = [row for row in range(len(self.dates)) 
+                if not self.dates[row] and self.mtimes[row]]
+    for row, date in zip(rows, 
+                    mtimeDates([self.mtimes[row] for row in rows])):
+      self.dates[row] = date
+    return len(rows)
+
+  def path(self, row) -> str:
+    return os.path.join(self.strings[self.dirs[row]], self.names[row])
+
+  def name(self, row) -> str:
+    return self.names[row]
+
+  def date(self, row):
+    date = self.dates[row]
+    return str(date) if date else None
+
+  def digest(self, row):
+    if self.nodigest[row]:
+      return None
+    return self.digests[row*16:row*16+16].hex()
 
-#  ********
-#  check if dir exists
-#  if not create it
-#  > returns True|False
-def doDirCreate(folders: list) -> bool:
+  def structure(self, row) -> str:
+    return self.strings[self.structs[row]]
 
-  # remove duplicates
-  folders=removeDuplicates(folders)
-  n=0
-  for folder in folders:
-    if n == 0 or n == 50: 
-      p(warning,'Creating folders in folder list'
-        , n, 'of', len(folders)) 
-      n=0
-    n+=1
-    target=settings["foldertarget"] 
-    drive, dirs = os.path.splitdrive(folder[0].replace(target,''))
-    splitdirs = dirs.split('\\')[1:]
-    if len(splitdirs)==0:
-      drive, dirs = os.path.splitdrive(str(folder).replace(target,''))
-      splitdirs = dirs.split('\\')[1:]
+  def category(self, row) -> str:
+    return self.strings[self.cats[row]]
 
-    p(allmsg,'Target root', target, 'folder', str(folder[0]), 
-         'drive', drive, 'path', dirs)
+  def extension(self, row) -> str:
+    return self.strings[self.exts[row]]
 
-    for dir in splitdirs:
-      target = target+'\\'+dir
-      p(allmsg,'Target for folder creation', target)
-      if not os.path.isdir(target):
-        try:
-          os.mkdir(target)
-          p(verbose,'Creation of', target, 'succeeded.')
-        except Exception as e:
-          p(error,'Creation failed with error message:',e)
-          pass
+  def size(self, row):
+    size = self.sizes[row]
+    return None if size < 0 else size
 
-  return True
+  #  ********
+  #  > returns (size, mtime_ns, inode) as taken 
+  #  during the search
+  def signature(self, row) -> tuple:
+    return (self.size(row), self.mtimes[row] or None, 
+            self.inodes[row] or None)
 
-#  ********
-#  check files from filelist
-#  against existing files
-#  on read error a hash is generated 
-#  from the time
-def hashfile(filepath:str):
+  #  ********
+  #  the record as a tuple, as appended
+  def record(self, row) -> tuple:
+    return (self.digest(row), self.path(row), self.names[row],
+            self.date(row), self.structure(row), self.category(row),
+            self.extension(row)) + self.signature(row)
 
-  result = datetime.datetime.now().strftime('%Y%m%dT%H%M%S%%f')
-  
-  try:
-    with open(filepath, 'rb') as inputfile:
-      data = inputfile.read(8196)
-    inputfile.close()
-    result = hashlib.md5(data).hexdigest()
-  except Exception as e:
-    p(warning, 'Couldn\'t get the hash for file filepath due to \
-                (probably) a permission error. Here is the error message', e)
-  
-  return result
+  def __iter__(self):
+    for row in range(len(self.names)):
+      yield self.record(row)
 
 #  ********
-#  check files from filelist
-#  against existing files
-def checkFiles(fileList) -> bool:
+#  list of rows of a FileStore, optionally with an
+#  (interned) target directory per row. iterating
+#  gives the tuples as written to the results csv,
+#  the signature of the source (size, mtime_ns, 
+#  inode, hash) is used to revalidate saved plans
+#  kind = "target" > (filepath, target file, signature)
+#  kind = "file"   > (filepath, other file, signature)
+#  kind = "date"   > (filepath, date, signature, target file)
+class StoreList:
+
+  __slots__ = ("store", "kind", "rows", "targets", "tsizes", "tmtimes")
+
+  def __init__(self, store: FileStore, kind: str):
+
+    self.store = store
+    self.kind = kind
+    self.rows = array.array('l')
+    self.targets = array.array('l')
+    # signature (size, mtime_ns) of the target file, 
+    # "date" rows only
+    self.tsizes = array.array('q')
+    self.tmtimes = array.array('q')
+
+  def append(self, row: int, target_dir=None, target_st=None):
+
+    self.rows.append(row)
+    self.targets.append(self.store.intern(target_dir))
+    if self.kind == "date":
+      self.tsizes.append(target_st.st_size if target_st else -1)
+      self.tmtimes.append(target_st.st_mtime_ns if target_st else 0)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def item(self, i) -> tuple:
+
+    row = self.rows[i]
+    signature = self.store.signature(row) + (self.store.digest(row),)
+    if self.kind == "target":
+      return (self.store.path(row),
+              os.path.join(self.store.strings[self.targets[i]],
+                           self.store.names[row])) + signature
+    if self.kind == "file":
+      return (self.store.path(row), 
+              self.store.strings[self.targets[i]]) + signature
+    # the target is the same file, so its hash is the
+    # hash of the source
+    return (self.store.path(row), self.store.date(row)) + signature + \
+           (os.path.join(self.store.strings[self.targets[i]],
+                         self.store.names[row]),
+            self.tsizes[i] if self.tsizes[i] >= 0 else None,
+            self.tmtimes[i] or None,
+            signature[3])
+
+  def __getitem__(self, i):
+    return self.item(i)
+
+  def __iter__(self):
+    for i in range(len(self.rows)):
+      yield self.item(i)
 
-  global now
-  global searchResults
+#  ********
+#  cache of open directory file descriptors (LRU) for
+#  dir_fd relative stat, open, rename, unlink and 
+#  mkdir, so the kernel does not resolve the full path
+#  for every operation. the identity (st_dev, st_ino)
+#  of a directory is compared with the path on every
+#  acquire, a directory that was replaced in between
+#  is reopened (fds still leased are closed on their
+#  last release). where
+#  dir_fd is not supported (windows) the plain paths
+#  are used
+class DirFds:
+
+  def __init__(self, size: int = 256):
+
+    self.size = max(0, int(size or 0))
+    self.supported = self.size > 0 and \
+                     os.open in os.supports_dir_fd and \
+                     os.stat in os.supports_dir_fd and \
+                     os.rename in os.supports_dir_fd and \
+                     os.unlink in os.supports_dir_fd and \
+                     os.mkdir in os.supports_dir_fd and \
+                     hasattr(os, 'O_DIRECTORY')
+    # folder > [fd, leases, (st_dev, st_ino)]
+    self.fds = collections.OrderedDict()
+    # fds of replaced folders still in use
+    self.stale = []
+    self.lock = threading.Lock()
+
+  #  ********
+  #  > returns the fd of a directory, with a lease
+  #  that must be released. a cached fd is checked
+  #  against the path, a folder that was replaced 
+  #  (removed and created again) is opened again
+  def acquire(self, folder: str) -> int:
+
+    st = os.stat(folder or '.')
+    with self.lock:
+      entry = self.fds.get(folder)
+      if entry:
+        if entry[2] == (st.st_dev, st.st_ino):
+          self.fds.move_to_end(folder)
+          entry[1] += 1
+          return entry[0]
+        # replaced, closed when no longer in use
+        del self.fds[folder]
+        if entry[1] <= 0:
+          os.close(entry[0])
+        else:
+          self.stale.append(entry)
+
+    fd = os.open(folder or '.', os.O_RDONLY | os.O_DIRECTORY)
+    fst = os.fstat(fd)
+    if (fst.st_dev, fst.st_ino) != (st.st_dev, st.st_ino):
+      # replaced while it was opened
+      os.close(fd)
+      raise OSError(errno.ESTALE, 'Directory was replaced', folder)
+    with self.lock:
+      entry = self.fds.get(folder)
+      if entry and entry[2] == (st.st_dev, st.st_ino):
+        # another thread was first
+        os.close(fd)
+        entry[1] += 1
+        return entry[0]
+      if entry:
+        del self.fds[folder]
+        self.stale.append(entry)
+      self.fds[folder] = [fd, 1, (st.st_dev, st.st_ino)]
+      self.evict()
+    return fd
+
+  def release(self, folder: str, fd: int):
+    with self.lock:
+      entry = self.fds.get(folder)
+      if entry and entry[0] == fd:
+        entry[1] -= 1
+      else:
+        for entry in self.stale:
+          if entry[0] == fd:
+            entry[1] -= 1
+            if entry[1] <= 0:
+              self.stale.remove(entry)
+              os.close(fd)
+            break
+      self.evict()
+
+  #  ********
+  #  close the least recently used fds not in use
+  def evict(self):
+    if len(self.fds) <= self.size:
+      return
+    for folder in list(self.fds):
+      if len(self.fds) <= self.size:
+        break
+      if self.fds[folder][1] <= 0:
+        os.close(self.fds.pop(folder)[0])
 
-  rootFolder = settings["foldertarget"]
-  renameFiles = []
-  noFolder = []
-  existsButDifferent = []
-  deleteSourceFile = []
+  #  ********
+  #  run function(name, dir_fd=fd) for a path
+  def call(self, function, path: str, **kwargs):
 
-  n=0
-  for file in fileList:
-    # file[0] = 'hashedvalue'
-    # file[1] = 'filepathname'
-    # file[2] = 'filename'
-    # file[3] = 'creationDate'
-    # file[4] = 'verificationType'
-    
-    if n == 0: 
-      p(verbose,'\nEvaluating', len(fileList), 'files \
-        in files list, busy with ', n)
-    n+=1
-    
-    if file[4] == 'ymd_structure':
-      # get root folder name
-      skip = False
-      try:
-        rootYear = file[3][0:4]
-        rootMonth = file[3][4:6]
-        rootDay = file[3][6:8]
-
-      except TypeError as e:
-        p(info,'A date type error exception occured when \
-          evaluating the file date of file', file,'Skipping \
-          this one, the error message was', e)
-        skip = True
-
-      if not skip:
-        target_dir = os.path.join(rootFolder,rootYear,
-                rootMonth,rootDay)
-
-        if Path(target_dir).is_dir():
-          # dir exists
-          target_file = os.path.join(target_dir,file[2])
-          if Path(target_file).is_file():
-            p(verbose,'File', file[2], 'from date', file[3],
-              'exists in', target_dir)
-            # verify md5 hash
-            hashedvalue = hashfile(target_file)
-            
-            if not file[0] == hashedvalue:
-              p(verbose,'File', file[2], 'from date', file[3], 
-                'exists in', target_dir, 'but has different \
-                hash value')
-              existsButDifferent.append((file[1],target_file))
-            else:
-              # file is the same
-              deleteSourceFile.append((file[1],file[3]))
-          else:
-            p(verbose,'File', file[2], 'from date', file[3], 
-              'does not exists in', target_dir)
-            renameFiles.append((file[1], target_file))
-        else:
-          p(verbose, 'Folder', target_dir, 'for file', file[2], \
-            'with date', file[3], 'does not exist.')
-          noFolder.append((target_dir))
-          # and add file as well to the list
-          renameFiles.append((file[1], 
-                os.path.join(target_dir,file[2])))
-    if n==50:
-      n=0
+    folder, name = os.path.split(path)
+    if not self.supported or not name:
+      return function(path, **kwargs)
 
-  p(info,'')
-  p(info, 'Files that are already present in \
-    target directory:', len(deleteSourceFile))
-  p(info, 'Files that are NOT present in \
-    target directory:', len(renameFiles))
-  p(info, 'Non existing TARGET directories:', len(noFolder))
-  p(info, 'Existing but from source different files (md5 hash) in \
-    TARGET directory:', len(existsButDifferent))
+    fd = self.acquire(folder)
+    try:
+      return function(name, dir_fd=fd, **kwargs)
+    finally:
+      self.release(folder, fd)
 
-  if settings["resultssave"] or settings["action"]:
-    p(info,'Saving results due to argument --saveresults (exit) or \
-      --action (continue).')
-    writeResultsToCsv(deleteSourceFile, now+"_deleteSourceFile.csv")
-    writeResultsToCsv(renameFiles, now+"_renameFiles.csv")
-    writeResultsToCsv(noFolder, now+"_noFolder.csv")
-    writeResultsToCsv(existsButDifferent, now+"_existsButDifferent.csv")
-    writeResultsToCsv(searchResults, now+"_searchResults.csv")
-    if not settings["action"]: 
-      raise SystemExit(0)
+  def stat(self, path: str, follow_symlinks=True):
+    return self.call(os.stat, path, follow_symlinks=follow_symlinks)
+
+  def isdir(self, path: str) -> bool:
+    try:
+      return stat.S_ISDIR(self.stat(path).st_mode)
+    except (OSError, ValueError):
+      return False
+
+  def isfile(self, path: str) -> bool:
+    try:
+      return stat.S_ISREG(self.stat(path).st_mode)
+    except (OSError, ValueError):
+      return False
+
+  def unlink(self, path: str):
+    return self.call(os.unlink, path)
+
+  def mkdir(self, path: str):
+    return self.call(os.mkdir, path)
+
+  def utime(self, path: str, times):
+
+    if not self.supported or os.utime not in os.supports_dir_fd:
+      return os.utime(path, times)
+    return self.call(os.utime, path, times=times)
+
+  #  ********
+  #  > returns a (binary) file object
+  def open(self, path: str, mode='rb'):
+
+    if not self.supported:
+      return open(path, mode)
+
+    flags = os.O_RDONLY if mode == 'rb' else \
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    fd = self.call(os.open, path, flags=flags, mode=0o666)
+    return os.fdopen(fd, mode)
+
+  def rename(self, source: str, target: str):
+
+    if not self.supported:
+      return os.rename(source, target)
+
+    sfolder, sname = os.path.split(source)
+    tfolder, tname = os.path.split(target)
+    sfd = self.acquire(sfolder)
+    try:
+      tfd = self.acquire(tfolder)
+      try:
+        return os.rename(sname, tname, src_dir_fd=sfd, dst_dir_fd=tfd)
+      finally:
+        self.release(tfolder, tfd)
+    finally:
+      self.release(sfolder, sfd)
+
+  def link(self, source: str, target: str):
+
+    if not self.supported or os.link not in os.supports_dir_fd:
+      return os.link(source, target)
+
+    sfolder, sname = os.path.split(source)
+    tfolder, tname = os.path.split(target)
+    sfd = self.acquire(sfolder)
+    try:
+      tfd = self.acquire(tfolder)
+      try:
+        return os.link(sname, tname, src_dir_fd=sfd, dst_dir_fd=tfd)
+      finally:
+        self.release(tfolder, tfd)
+    finally:
+      self.release(sfolder, sfd)
+
+  #  ********
+  #  copy on write clone (FICLONE, Linux btrfs/xfs), the
+  #  data is shared until one of the files changes
+  def reflink(self, source: str, target: str):
+
+    if fcntl is None:
+      raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported', 
+                    target)
+
+    with self.open(source, 'rb') as src:
+      st = os.fstat(src.fileno())
+      try:
+        with self.open(target, 'wb') as dst:
+          fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+          os.chmod(dst.fileno(), stat.S_IMODE(st.st_mode))
+          os.utime(dst.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+      except OSError:
+        try:
+          self.unlink(target)
+        except OSError:
+          pass
+        raise
+    return target
+
+  #  ********
+  #  copy with data and times/mode (like copy2), the
+  #  target is created exclusive
+  def copy(self, source: str, target: str):
+
+    if not self.supported and not throttle:
+      return shutil.copy2(source, target)
+
+    # throttled per chunk (copyThrottled)
+    with self.open(source, 'rb') as src:
+      st = os.fstat(src.fileno())
+      with self.open(target, 'wb') as dst:
+        copyThrottled(src, dst, source, target)
+        dst.flush()
+        if self.supported:
+          os.chmod(dst.fileno(), stat.S_IMODE(st.st_mode))
+          os.utime(dst.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+    if not self.supported:
+      shutil.copystat(source, target)
+    return target
+
+  #  ********
+  #  > returns list of DirEntry objects of a folder
+  def scandir(self, path: str) -> list:
+    with os.scandir(path) as entries:
+      return list(entries)
+
+  def close(self):
+    with self.lock:
+      for folder in list(self.fds):
+        os.close(self.fds.pop(folder)[0])
+      for entry in self.stale:
+        os.close(entry[0])
+      self.stale = []
+
+  #  ********
+  #  close the fds not in use (at the end of a job)
+  def reset(self):
+    with self.lock:
+      for folder in list(self.fds):
+        if self.fds[folder][1] <= 0:
+          os.close(self.fds.pop(folder)[0])
+
+dirfds = StateProxy("dirfds")
+
+#  ********
+#  stand-in for a slow or unreliable (network) file
+#  system, for measuring and testing on a local disk.
+#  every operation of DirFds (and so of the walker, 
+#  the search and the actions) waits latency +- jitter
+#  seconds and fails with a chance of errors, with one
+#  of the given errnos that fits the operation
+class SimulatedFs(DirFds):
+
+  # errnos that an operation can give
+  operationErrors = {
+    "scandir": (errno.EIO,),
+    "stat": (errno.EIO,),
+    "open": (errno.EIO,),
+    "write": (errno.EIO, errno.ENOSPC),
+    "mkdir": (errno.EIO, errno.ENOSPC),
+    "unlink": (errno.EIO,),
+    "utime": (errno.EIO,),
+    "rename": (errno.EIO, errno.EXDEV),
+    "link": (errno.EIO, errno.EXDEV, errno.ENOSPC),
+    "reflink": (errno.EIO, errno.EXDEV, errno.ENOSPC),
+  }
+
+  def __init__(self, size: int = 256, latency: float = 0.0, 
+               jitter: float = 0.0, errors: float = 0.0, 
+               errnos=(errno.EIO,), seed=None):
+
+    super().__init__(size)
+    self.latency = float(latency)
+    self.jitter = float(jitter)
+    self.errors = float(errors)
+    self.errnos = tuple(errnos)
+    self.random = random.Random(seed)
+    self.randomLock = threading.Lock()
+    self.operations = collections.Counter()
+    self.failures = collections.Counter()
+    self.waited = 0.0
+
+  #  ********
+  #  wait, and fail now and then
+  def inject(self, operation: str, path: str):
+
+    possible = [code for code in self.errnos 
+                if code in self.operationErrors[operation]]
+    with self.randomLock:
+      wait = max(0.0, self.latency + 
+                      self.random.uniform(-self.jitter, self.jitter))
+      code = self.random.choice(possible) if possible and \
+             self.random.random() < self.errors else None
+      self.operations[operation] += 1
+      self.waited += wait
+      if code:
+        self.failures[operation + ' ' + errno.errorcode[code]] += 1
+    if wait:
+      time.sleep(wait)
+    if code:
+      raise OSError(code, os.strerror(code) + ' (simulated)', path)
+
+  def scandir(self, path: str) -> list:
+    self.inject("scandir", path)
+    return super().scandir(path)
+
+  def stat(self, path: str, follow_symlinks=True):
+    self.inject("stat", path)
+    return super().stat(path, follow_symlinks)
+
+  def open(self, path: str, mode='rb'):
+    self.inject("open" if mode == 'rb' else "write", path)
+    return super().open(path, mode)
+
+  def mkdir(self, path: str):
+    self.inject("mkdir", path)
+    return super().mkdir(path)
+
+  def unlink(self, path: str):
+    self.inject("unlink", path)
+    return super().unlink(path)
+
+  def utime(self, path: str, times):
+    self.inject("utime", path)
+    return super().utime(path, times)
+
+  def rename(self, source: str, target: str):
+    self.inject("rename", target)
+    return super().rename(source, target)
+
+  def link(self, source: str, target: str):
+    self.inject("link", target)
+    return super().link(source, target)
+
+  def reflink(self, source: str, target: str):
+    self.inject("reflink", target)
+    return super().reflink(source, target)
+
+  #  ********
+  #  > returns [(operation, count, failures)]
+  def summary(self) -> list:
+    return [(operation, count, sum(failed for name, failed in 
+                                   self.failures.items() 
+                                   if name.split(' ')[0] == operation))
+            for operation, count in sorted(self.operations.items())]
+
+#  ********
+#  the directory fds, or with --simulate the stand-in,
+#  in the form latency=0.02,jitter=0.01,errors=0.001,
+#  errno=EIO+EXDEV+ENOSPC,seed=1 (times in seconds, or
+#  with ms)
+def initializeDirFds():
+
+  if not settings["simulate"]:
+    return DirFds(settings["dirfds"])
+
+  options = {}
+  try:
+    for part in settings["simulate"].split(','):
+      key, value = part.split('=', 1)
+      key = key.strip().lower()
+      value = value.strip()
+      if key in ("latency", "jitter"):
+        options[key] = float(value[:-2]) / 1000 \
+                       if value.endswith('ms') else float(value)
+      elif key == "errors":
+        options[key] = float(value)
+      elif key == "errno":
+        options["errnos"] = [getattr(errno, code.strip().upper()) 
+                             for code in value.split('+')]
+      elif key == "seed":
+        options[key] = int(value)
+      else:
+        raise ValueError('unknown key ' + key)
+  except (ValueError, AttributeError) as e:
+    p(critical, 'Argument --simulate', settings["simulate"], 
+      'is not valid,', e)
+    raise Mf2fsError('invalid --simulate ' + settings["simulate"])
+
+  p(warning, 'Simulating a file system with', options)
+  return SimulatedFs(settings["dirfds"], **options)
+
+#  ********
+#  token bucket, tokens are taken after the fact so
+#  the balance can go negative (the operation is done
+#  and paid for by waiting). rate 0 is unlimited
+class TokenBucket:
+
+  def __init__(self, rate: float, burst=None):
+
+    self.rate = float(rate or 0)
+    self.limit = self.rate
+    self.burst = float(burst) if burst else max(self.rate, 1.0)
+    self.tokens = self.burst
+    self.stamp = time.monotonic()
+    self.lock = threading.Lock()
+
+  #  ********
+  #  > returns the seconds to wait
+  def take(self, amount: float) -> float:
+
+    if self.rate <= 0:
+      return 0.0
+
+    with self.lock:
+      stamp = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + 
+                        (stamp - self.stamp) * self.rate)
+      self.stamp = stamp
+      self.tokens -= amount
+      if self.tokens >= 0:
+        return 0.0
+      return -self.tokens / self.rate
+
+#  ********
+#  i/o throttle per device, a bucket for bytes and one
+#  for file operations. with adaptive back-off the
+#  rates are scaled down when the observed latency
+#  spikes above the baseline and slowly restored
+class IoThrottle:
+
+  def __init__(self, limits: dict, adaptive=False):
+
+    # limits: device (or None for the default) > 
+    # (bytes per second, operations per second)
+    self.limits = limits
+    self.adaptive = adaptive
+    self.devices = {}
+    self.dirs = {}
+    self.lock = threading.Lock()
+
+  #  ********
+  #  > returns the device of a path, cached per folder
+  def device(self, path: str):
+
+    folder = os.path.dirname(os.path.abspath(path))
+    try:
+      return self.dirs[folder]
+    except KeyError:
+      pass
+    try:
+      device = dirfds.stat(folder).st_dev
+    except OSError:
+      device = None
+    if not device:
+      device = os.path.splitdrive(folder)[0]
+    self.dirs[folder] = device
+    return device
+
+  #  ********
+  #  > returns the state of a device
+  def state(self, device) -> dict:
+
+    try:
+      return self.devices[device]
+    except KeyError:
+      pass
+    with self.lock:
+      if device not in self.devices:
+        rates = self.limits.get(device, self.limits.get(None, (0, 0)))
+        self.devices[device] = {
+          "bytes": TokenBucket(rates[0]),
+          "ops": TokenBucket(rates[1]),
+          "scale": 1.0,
+          "latency": None,
+          "baseline": None,
+        }
+      return self.devices[device]
+
+  #  ********
+  #  account for one operation of nbytes on the device
+  #  of path that started at begin (time.monotonic()),
+  #  sleeps when the device is over its limits
+  def done(self, path: str, nbytes=0, begin=None):
+
+    state = self.state(self.device(path))
+    wait = max(state["bytes"].take(nbytes), state["ops"].take(1))
+
+    if self.adaptive and begin is not None:
+      elapsed = time.monotonic() - begin
+      wait = max(wait, self.backoff(state, elapsed))
+
+    if wait > 0:
+      time.sleep(min(wait, 60))
+
+  #  ********
+  #  take nbytes from the bucket of the device of path
+  #  before they are read or written, sleeps when the 
+  #  device is over its limit
+  def take(self, path: str, nbytes: int):
+
+    state = self.state(self.device(path))
+    wait = state["bytes"].take(nbytes)
+    if wait > 0:
+      time.sleep(min(wait, 60))
+
+  #  ********
+  #  adaptive back-off on latency spikes
+  #  > returns extra seconds to wait
+  def backoff(self, state: dict, elapsed: float) -> float:
+
+    with self.lock:
+      latency = state["latency"] = elapsed if state["latency"] is None \
+                    else 0.8 * state["latency"] + 0.2 * elapsed
+      baseline = state["baseline"]
+      if baseline is None or latency < baseline:
+        baseline = latency
+      else:
+        # the baseline follows slowly
+        baseline = 0.999 * baseline + 0.001 * latency
+      state["baseline"] = baseline
+
+      scale = state["scale"]
+      if latency > 3 * baseline and latency > 0.005:
+        scale = max(0.05, scale * 0.5)
+      elif latency < 1.5 * baseline:
+        scale = min(1.0, scale * 1.05)
+      if scale != state["scale"]:
+        p(allmsg, 'Throttle scale', round(scale, 2), 'latency', 
+          round(latency*1000, 1), 'ms baseline', 
+          round(baseline*1000, 1), 'ms')
+        state["scale"] = scale
+        for bucket in (state["bytes"], state["ops"]):
+          bucket.rate = bucket.limit * scale
+
+    if scale >= 1.0:
+      return 0.0
+    # unlimited buckets are scaled with a duty cycle
+    return elapsed * (1 / scale - 1)
+
+#  ********
+#  parse the --iolimit arguments, in the form
+#  bytes=20M,ops=100[@path] (no path is the default)
+#  > returns dict device > (bytes/s, ops/s)
+def initializeThrottle():
+
+  if not settings["iolimit"] and not settings["ioadaptive"]:
+    return None
+
+  units = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}
+  limits = {}
+  for spec in settings["iolimit"]:
+    values, sep, path = spec.partition('@')
+    device = None
+    if path:
+      try:
+        device = os.stat(path).st_dev or os.path.splitdrive(
+                   os.path.abspath(path))[0]
+      except OSError as e:
+        p(critical, 'Path', path, 'of --iolimit', spec, 'not found', e)
+        raise Mf2fsError('invalid --iolimit ' + spec)
+
+    rates = [None, None]
+    for value in values.split(','):
+      key, sep, amount = value.partition('=')
+      match = re.fullmatch(r'(\d+(?:\.\d+)?)([kmg]?)', 
+                           amount.strip().lower())
+      if key.strip() not in ('bytes', 'ops') or not match:
+        p(critical, 'Invalid --iolimit', spec, 'use the form \
+          bytes=20M,ops=100[@path]')
+        raise Mf2fsError('invalid --iolimit ' + spec)
+      rate = float(match.group(1)) * units[match.group(2)]
+      rates[0 if key.strip() == 'bytes' else 1] = rate
+    limits[device] = rates
+
+  # values not given for a device are the defaults
+  default = limits.get(None, [None, None])
+  for device in limits:
+    limits[device] = tuple(limits[device][i] if limits[device][i] 
+                           is not None else (default[i] or 0) 
+                           for i in (0, 1))
+
+  p(info, 'I/O limits', ', '.join(
+      (str(d) if d is not None else 'default') + ' ' + 
+      str(int(r[0])) + ' bytes/s ' + str(int(r[1])) + ' ops/s' 
+      for d, r in limits.items()) or 'none',
+    '(adaptive)' if settings["ioadaptive"] else '')
+
+  return IoThrottle(limits, settings["ioadaptive"])
+
+throttle = StateProxy("throttle")
+
+#  ********
+#  account an i/o operation with the throttle (if any)
+def ioDone(path, nbytes=0, begin=None):
+  if throttle:
+    throttle.done(path, nbytes, begin)
+
+#  ********
+#  copy a stream in chunks, the bytes of a chunk are
+#  taken from the throttle (if any) of the source and
+#  the target before the chunk is written, so a large
+#  file does not burst past the limits
+#  > returns the number of bytes copied
+def copyThrottled(src, dst, source: str, target: str) -> int:
+
+  total = 0
+  while True:
+    chunk = src.read(1024*1024)
+    if not chunk:
+      break
+    if throttle:
+      throttle.take(source, len(chunk))
+      throttle.take(target, len(chunk))
+    dst.write(chunk)
+    total += len(chunk)
+  return total
+
+#  ********
+#  set idle i/o priority for this process
+#  > returns True|False
+def setIdlePriority() -> bool:
+
+  try:
+    if psutil:
+      if sys.platform == 'win32':
+        psutil.Process().ionice(psutil.IOPRIO_VERYLOW)
+      else:
+        psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+    elif sys.platform.startswith('linux'):
+      subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())],
+                     check=True, capture_output=True)
+    else:
+      p(warning, 'Idle I/O priority needs the psutil package \
+        on this platform.')
+      return False
+  except Exception as e:
+    p(warning, 'Setting idle I/O priority failed with error', e)
+    return False
+
+  p(info, 'Running with idle I/O priority.')
+  return True
+
+#  ********
+#  delete one file
+def deleteFile(files) -> bool:
+
+  if splitArchivePath(files[0]):
+    p(verbose, 'Archive member', files[0], 'is not deleted.')
+    return False
+
+  try:
+    begin = time.monotonic()
+    dirfds.unlink(files[0]) 
+    ioDone(files[0], 0, begin)
+    return True
+
+  except IsADirectoryError as i:
+    p(warning, 'Removing a directory', files[0]
+         , 'is not supported, error ', i)
+
+  except Exception as e:
+    p(error, 'Deleting file', files[0], 'failed with error', 
+         e, 'Do you have sufficient rights?')
+
+  return False
+
+#  ********
+#  delete file
+#  > returns True|False
+def deleteFiles(filelist) -> bool:
+
+  scheduler = DeviceScheduler(settings["iothreads"], 
+                              path=lambda files: files[0])
+  for result in scheduler.run(filelist, deleteFile):
+    pass
+
+  return True
+
+#  ********
+#  rename (or copy) one file
+def renameTheFile(files) -> bool:
+
+  rename = files[0][:1] == files[1][:1]
+  if rename: 
+    try:
+      begin = time.monotonic()
+      dirfds.rename(os.path.join(files[0]), os.path.join(files[1])) 
+      ioDone(files[0], 0, begin)
+      if catalog:
+        catalog.add(files[1])
+      return True
+    except OSError as w:
+      if w.errno == errno.EXDEV:
+        # another device (mount) after all, copy it
+        p(verbose, 'File', files[0], 'is on another device, copying.')
+        rename = False
+      else:
+        p(error, 'File', files[0], 'gives me a message while \
+              renaming', w)
+    except Exception as e:
+      p(error, 'Renaming file', os.path.join(files[0])
+           , 'to', os.path.join(files[1])
+           , 'failed with error', e
+           , 'Do you have sufficient rights?')
+
+  if not rename:
+    try:
+      begin = time.monotonic()
+      dirfds.copy(files[0], files[1])
+      ioDone(files[0], 0, begin)
+      ioDone(files[1])
+      if dirfds.isfile(files[1]):
+        if catalog:
+          catalog.add(files[1])
+        if settings["sourcedelete"]:
+          deleteFile(files)
+        return True
+      else:
+        p(info, 'No erros but file doesn\'t exist. Bummer.')
+    except Exception as c:
+      p(error, 'This didn\'t work, sorry: ', c)
+
+  return False
+
+#  ********
+#  sort that keeps at most runsize items in memory,
+#  sorted runs are written to temporary files and 
+#  merged when read. iterating yields (key, item)
+class ExternalSort:
+
+  # items per pickle in a run file
+  chunk = 1024
+
+  def __init__(self, key, runsize: int = 200000, tempdir=None):
+
+    self.key = key
+    self.runsize = max(1, int(runsize or 1))
+    self.tempdir = tempdir
+    self.buffer = []
+    self.runs = []
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def add(self, item):
+
+    self.buffer.append((self.key(item), item))
+    self.count += 1
+    if len(self.buffer) >= self.runsize:
+      self.spill()
+
+  #  ********
+  #  write the buffer as a sorted run
+  def spill(self):
+
+    self.buffer.sort(key=lambda kv: kv[0])
+    run = tempfile.TemporaryFile(dir=self.tempdir)
+    for i in range(0, len(self.buffer), self.chunk):
+      pickle.dump(self.buffer[i:i+self.chunk], run, 
+                  pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    self.runs.append(run)
+    self.buffer = []
+
+  def read(self, run):
+    while True:
+      try:
+        chunk = pickle.load(run)
+      except EOFError:
+        return
+      yield from chunk
+
+  def __iter__(self):
+
+    if not self.runs:
+      self.buffer.sort(key=lambda kv: kv[0])
+      return iter(self.buffer)
+    if self.buffer:
+      self.spill()
+    return heapq.merge(*[self.read(run) for run in self.runs], 
+                       key=lambda kv: kv[0])
+
+  def close(self):
+    for run in self.runs:
+      run.close()
+    self.runs = []
+    self.buffer = []
+
+#  ********
+#  device of a folder (or of the nearest existing 
+#  parent), cached per folder
+folderDevices = StateProxy("folderDevices")
+
+def folderDevice(folder: str) -> str:
+
+  try:
+    return folderDevices[folder]
+  except KeyError:
+    pass
+
+  path = folder
+  while True:
+    try:
+      device = dirfds.stat(path or '.').st_dev
+      break
+    except OSError:
+      parent = os.path.dirname(path)
+      if parent == path:
+        device = 0
+        break
+      path = parent
+  result = str(device or os.path.splitdrive(os.path.abspath(folder))[0])
+  folderDevices[folder] = result
+  return result
+
+#  ********
+#  sort key of a rename (or link) of a plan: target 
+#  device, target folder, source device, source inode
+def planKey(item) -> tuple:
+
+  target = os.path.dirname(item[1])
+  try:
+    inode = int(item[4])
+  except (IndexError, TypeError, ValueError):
+    inode = 0
+  return (folderDevice(target), target, 
+          folderDevice(os.path.dirname(item[0])), inode)
+
+#  ********
+#  link file into the target (--link), the source 
+#  stays. a hardlink (or reflink) that is not possible,
+#  such as across filesystems, becomes a copy
+#  > returns True|False
+def linkTheFile(files) -> bool:
+
+  try:
+    begin = time.monotonic()
+    try:
+      if settings["link"] == "reflink":
+        dirfds.reflink(files[0], files[1])
+      else:
+        dirfds.link(files[0], files[1])
+      ioDone(files[0], 0, begin)
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, 
+                         errno.EOPNOTSUPP, errno.ENOTSUP, 
+                         errno.EINVAL, errno.ENOTTY):
+        raise
+      p(verbose, 'Linking', files[0], 'is not possible (' + 
+        os.strerror(e.errno) + '), copying.')
+      dirfds.copy(files[0], files[1])
+      ioDone(files[0], 0, begin)
+      ioDone(files[1])
+    if catalog:
+      catalog.add(files[1])
+    return True
+
+  except Exception as e:
+    p(error, 'Linking file', files[0], 'to', files[1], 
+      'failed with error', e)
+  return False
+
+#  ********
+#  rename files, the plan is sorted (on disk when
+#  large) on target folder and then on source device
+#  and inode, and renamed a target folder at a time
+#  > returns True|False
+def renameTheFiles(filelist: list, worker=None) -> bool:
+
+  # members of archives are written per archive
+  members = {}
+  sorter = ExternalSort(planKey, settings["sortbuffer"])
+  for item in filelist:
+    member = splitArchivePath(item[0])
+    if member:
+      members.setdefault(member[0], []).append((member[1], item[1]))
+    else:
+      sorter.add(item)
+  for archivepath, wanted in members.items():
+    p(info, 'Writing', len(wanted), 'members of archive', archivepath)
+    materializeArchive(archivepath, wanted)
+  p(verbose, 'Sorted', len(sorter), 'files on target folder', 
+    '(' + str(len(sorter.runs)), 'run(s) on disk).')
+
+  # per target folder one existence check, the files
+  # of a folder are renamed in source device and inode
+  # order (--iothreads at a time)
+  worker = worker or renameTheFile
+  pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, settings["iothreads"]),
+                initializer=runState.set, initargs=(currentState(),))
+  n=0
+  t=1
+  folders=0
+  try:
+    for (device, folder), batch in itertools.groupby(sorter, 
+                                       key=lambda kv: kv[0][:2]):
+      batch = [item for key, item in batch]
+      folders+=1
+      if not dirfds.isdir(folder):
+        if settings["foldercreate"]:
+          doDirCreate([(folder,)])
+        else:
+          p(error, 'Target folder', folder, 'does not exist,', 
+            len(batch), 'file(s) skipped.')
+          continue
+      for result in pool.map(worker, batch):
+        if n == 0 or n==50:
+          p(warning,'Renaming (or copying) files from  files list'
+            , t, 'of', len(sorter))
+          n=0
+        n+=1
+        t+=1
+  finally:
+    pool.shutdown()
+    sorter.close()
+
+  p(verbose, 'Renamed', t-1, 'files in', folders, 'target folder(s).')
+  return True
+
+#  ********
+#  write results to files
+def writeResultsToCsv(list: list, outputfile) -> bool:
+  try:
+    with open(outputfile, "w", newline="") as f:
+      writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_ALL)
+      writer.writerows(list)
+    f.close()
+    return True
+  except Exception as e:
+    p(error, 'Saving file', outputfile, 'with', len(list)
+         , 'records failed with error', e
+         , 'Do you have sufficient rights?')
+    return False
+
+#  ********
+#  write results to a file row by row, the file is
+#  created with the first row
+class ResultsWriter:
+
+  def __init__(self, outputfile):
+    self.outputfile = outputfile
+    self.file = None
+    self.writer = None
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def append(self, row):
+    if self.writer is None:
+      self.file = open(self.outputfile, "w", newline="")
+      self.writer = csv.writer(self.file, delimiter='\t', 
+                               quoting=csv.QUOTE_ALL)
+    self.writer.writerow(row)
+    self.count += 1
+
+  def close(self):
+    if self.file:
+      self.file.close()
+      self.file = None
+
+#  ********
+#  read results from a file row by row, so a large 
+#  plan is never held as a whole
+#  > yields rows
+def readResultsFromCsv(filename):
+  try:
+    with open(filename, "r", newline="") as f:
+      yield from csv.reader(f, delimiter='\t')
+  except Exception as e:
+    p(error, 'Loading results file', filename
+         , 'failed with error', e
+         , 'Do you have sufficient rights?')
+
+#  ********
+#  load results from files
+def loadResultsFromCsv(filename) -> list:
+  try:
+    with open(filename, "r", newline="") as f:
+      reader = csv.reader(f, delimiter='\t')
+      csvdata = list(reader)
+    f.close()
+    return csvdata
+  except Exception as e:
+    p(error, 'Loading results file', filename
+         , 'failed with error', e
+         , 'Do you have sufficient rights?')
+    return False
+
+#  ********
+# remove duplicates from list
+def removeDuplicates(inlist)->list:
+
+  list_set = set(inlist)
+  unique_list = (list(list_set))
+  return unique_list
+
+#  ********
+#  check if dir exists
+#  if not create it
+#  > returns True|False
+def doDirCreate(folders: list) -> bool:
+
+  # remove duplicates
+  folders=removeDuplicates(tuple(f) if isinstance(f, list) else f 
+                           for f in folders)
+  n=0
+  created=0
+  for folder in folders:
+    if n == 0 or n == 50: 
+      p(warning,'Creating folders in folder list'
+        , n, 'of', len(folders)) 
+      n=0
+    n+=1
+    target=settings["foldertarget"] 
+    folder = folder[0] if isinstance(folder, (list, tuple)) else folder
+    try:
+      dirs = os.path.relpath(folder, target)
+    except ValueError as v:
+      # another drive (windows)
+      p(error, 'Folder', folder, 'is not under target', target, v)
+      continue
+    splitdirs = [d for d in re.split(r'[\\/]', dirs) if d not in ('', '.')]
+    if '..' in splitdirs or os.path.isabs(dirs):
+      # a (saved) plan pointing outside the target
+      p(error, 'Folder', folder, 'is not under target', target, 
+        'and is not created.')
+      continue
+
+    p(allmsg,'Target root', target, 'folder', folder, 'path', dirs)
+
+    for dir in splitdirs:
+      # each folder is created relative to its parent
+      target = os.path.join(target, dir)
+      p(allmsg,'Target for folder creation', target)
+      if not dirfds.isdir(target):
+        try:
+          begin = time.monotonic()
+          dirfds.mkdir(target)
+          ioDone(target, 0, begin)
+          created += 1
+          p(verbose,'Creation of', target, 'succeeded.')
+        except Exception as e:
+          p(error,'Creation failed with error message:',e)
+          pass
+
+  # the new folders had the device of their parent
+  if created:
+    folderDevices.clear()
+
+  return True
+
+#  ********
+#  the leading bytes of a file, read once and shared
+#  by the hash and the metadata extractor. it acts as
+#  a (read only) file for exifread, reads beyond the
+#  head go to the file itself
+class HeadReader:
+
+  # enough for the hash, read when the file is opened
+  hashsize = 8196
+  # the head is extended in blocks when an extractor
+  # reads beyond it (enough for most exif headers)
+  headsize = 65536
+
+  def __init__(self, filepath: str):
+
+    self.filepath = filepath
+    begin = time.monotonic()
+    self.file = dirfds.open(filepath)
+    try:
+      self.head = self.file.read(self.hashsize)
+    except Exception:
+      self.file.close()
+      raise
+    ioDone(filepath, len(self.head), begin)
+    # the head is the whole file
+    self.whole = len(self.head) < self.hashsize
+    self.pos = 0
+    self.extra = 0
+
+  #  ********
+  #  read nbytes more into the head
+  def extend(self, nbytes: int):
+
+    begin = time.monotonic()
+    self.file.seek(len(self.head))
+    more = self.file.read(nbytes)
+    ioDone(self.filepath, len(more), begin)
+    self.extra += 1
+    self.head += more
+    self.whole = len(more) < nbytes
+
+  def read(self, size=-1) -> bytes:
+
+    if size is None or size < 0:
+      end = None
+    else:
+      end = self.pos + size
+    if end is not None and end > len(self.head) and not self.whole \
+       and self.pos <= len(self.head) + self.headsize:
+      # near the head, the small reads of an extractor
+      # are served from the extended head
+      self.extend(max(end - len(self.head), self.headsize))
+    head = len(self.head)
+    if self.whole or end is not None and end <= head:
+      data = self.head[self.pos:end]
+      self.pos += len(data)
+      return data
+
+    # far from the head or up to the end
+    data = self.head[self.pos:] if self.pos < head else b''
+    begin = time.monotonic()
+    self.file.seek(max(self.pos, head))
+    more = self.file.read(-1 if end is None else end - 
+                          max(self.pos, head))
+    ioDone(self.filepath, len(more), begin)
+    self.extra += 1
+    self.pos += len(data) + len(more)
+    return data + more
+
+  def seek(self, offset, whence=0) -> int:
+    if whence == 1:
+      offset += self.pos
+    elif whence == 2:
+      offset += os.fstat(self.file.fileno()).st_size
+    self.pos = max(0, offset)
+    return self.pos
+
+  def tell(self) -> int:
+    return self.pos
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+#  ********
+#  check files from filelist
+#  against existing files
+#  on read error a hash is generated 
+#  from the time. the head of an already
+#  opened file (HeadReader) can be passed
+def hashfile(filepath:str, reader=None):
+
+  result = datetime.datetime.now().strftime('%Y%m%dT%H%M%S%%f')
+  
+  try:
+    if reader:
+      data = reader.head[:8196]
+    else:
+      begin = time.monotonic()
+      with dirfds.open(filepath) as inputfile:
+        data = inputfile.read(8196)
+      inputfile.close()
+      ioDone(filepath, len(data), begin)
+    result = hashlib.md5(data).hexdigest()
+  except Exception as e:
+    p(warning, 'Couldn\'t get the hash for file filepath due to \
+                (probably) a permission error. Here is the error message', e)
+  
+  return result
+
+#  ********
+#  md5 of the whole contents of a file (or of an
+#  archive member), hashfile only covers the head
+#  > returns the hash or None on a read error
+def fullHash(filepath: str):
+
+  member = splitArchivePath(filepath)
+  if member and archiveType(member[0]) != "zip":
+    digest = tarDigests(member[0]).get(member[1])
+    if digest is None:
+      p(warning, 'Couldn\'t read all of', filepath)
+    return digest
+
+  digest = hashlib.md5()
+  total = 0
+  begin = time.monotonic()
+  try:
+    with memberStream(*member) if member else \
+         dirfds.open(filepath) as inputfile:
+      while True:
+        chunk = inputfile.read(1024*1024)
+        if not chunk:
+          break
+        digest.update(chunk)
+        total += len(chunk)
+  except Exception as e:
+    p(warning, 'Couldn\'t read all of', filepath, 'error', e)
+    return None
+
+  ioDone(member[0] if member else filepath, total, begin)
+  return digest.hexdigest()
+
+#  ********
+#  persistent catalog of the --target tree, content
+#  hash (md5 as in hashfile) and size per path with
+#  the size/mtime signature the hash was taken with.
+#  the md5 of the whole contents (digest) is taken 
+#  when a file is a candidate for a match only.
+#  kept in a sqlite database so lookups for millions
+#  of files do not need a rescan of the archive
+class TargetCatalog:
+
+  def __init__(self, dbfile: str, root: str):
+
+    self.dbfile = dbfile
+    self.root = root
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(dbfile, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.execute('CREATE TABLE IF NOT EXISTS files ( \
+      path TEXT PRIMARY KEY, hash TEXT NOT NULL, \
+      size INTEGER NOT NULL, mtime INTEGER NOT NULL)')
+    self.db.execute('CREATE INDEX IF NOT EXISTS files_hash \
+      ON files (hash, size)')
+    try:
+      # catalogs made before the digest column
+      self.db.execute('ALTER TABLE files ADD COLUMN digest TEXT')
+    except sqlite3.OperationalError:
+      pass
+    self.changes = 0
+
+  def __len__(self):
+    with self.lock:
+      return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+  #  ********
+  #  add (or update) a path, the hash is only
+  #  calculated when the signature changed
+  #  > returns the hash
+  def add(self, path: str, hashedvalue=None, st=None):
+
+    path = os.path.abspath(path)
+    try:
+      st = st or dirfds.stat(path)
+    except OSError as e:
+      p(verbose, 'Catalog can not stat', path, e)
+      self.remove(path)
+      return None
+
+    with self.lock:
+      row = self.db.execute('SELECT hash, size, mtime FROM files \
+              WHERE path = ?', (path,)).fetchone()
+    if row and row[1] == st.st_size and row[2] == st.st_mtime_ns:
+      return row[0]
+
+    if hashedvalue is None:
+      hashedvalue = hashfile(path)
+    # a changed file loses its digest
+    with self.lock:
+      self.db.execute('INSERT OR REPLACE INTO files \
+        (path, hash, size, mtime) VALUES (?, ?, ?, ?)',
+        (path, hashedvalue, st.st_size, st.st_mtime_ns))
+      self.commit(1)
+
+    return hashedvalue
+
+  #  ********
+  #  md5 of the whole contents of a path, calculated
+  #  once per signature (st, as the path was added)
+  #  > returns the digest or None
+  def digest(self, path: str, st):
+
+    path = os.path.abspath(path)
+    with self.lock:
+      row = self.db.execute('SELECT digest FROM files WHERE path = ? \
+              AND size = ? AND mtime = ?', 
+              (path, st.st_size, st.st_mtime_ns)).fetchone()
+    if row is None:
+      return None
+    if row[0]:
+      return row[0]
+
+    digest = fullHash(path)
+    if digest:
+      with self.lock:
+        self.db.execute('UPDATE files SET digest = ? WHERE path = ? \
+          AND size = ? AND mtime = ?', 
+          (digest, path, st.st_size, st.st_mtime_ns))
+        self.commit(1)
+    return digest
+
+  def remove(self, path: str):
+    with self.lock:
+      self.db.execute('DELETE FROM files WHERE path = ?',
+                      (os.path.abspath(path),))
+      self.commit(1)
+
+  #  ********
+  #  > returns the paths with the same hash (and size)
+  def lookup(self, hashedvalue, size=None) -> list:
+
+    with self.lock:
+      if size is None:
+        rows = self.db.execute('SELECT path FROM files \
+                 WHERE hash = ?', (hashedvalue,)).fetchall()
+      else:
+        rows = self.db.execute('SELECT path FROM files \
+                 WHERE hash = ? AND size = ?', 
+                 (hashedvalue, size)).fetchall()
+    return [row[0] for row in rows]
+
+  #  ********
+  #  incremental update, walks the tree and only
+  #  hashes files with a changed size/mtime signature
+  def refresh(self) -> bool:
+
+    p(info, 'Refreshing catalog', self.dbfile, 'of', self.root)
+    with self.lock:
+      known = {row[0]: (row[1], row[2]) for row in 
+         self.db.execute('SELECT path, size, mtime FROM files')}
+
+    dbfiles = {os.path.abspath(self.dbfile + x) 
+               for x in ('', '-wal', '-shm', '-journal')}
+    added = 0
+    n = 0
+    folders = [self.root]
+    while folders:
+      folder = folders.pop()
+      try:
+        entries = dirfds.scandir(folder)
+      except OSError as e:
+        p(warning, 'Catalog can not list', folder, e)
+        # the files under it are kept as they are
+        under = os.path.join(os.path.abspath(folder), '')
+        for path in [path for path in known if path.startswith(under)]:
+          del known[path]
+        continue
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          folders.append(entry.path)
+          continue
+        path = os.path.abspath(entry.path)
+        if path in dbfiles:
+          continue
+        try:
+          st = dirfds.stat(path)
+          if not stat.S_ISREG(st.st_mode):
+            continue
+        except OSError:
+          continue
+        signature = known.pop(path, None)
+        if signature != (st.st_size, st.st_mtime_ns):
+          self.add(path, st=st)
+          added+=1
+        n+=1
+        if n % 10000 == 0:
+          p(info, '\t... catalog checked', n, 'files,', added,
+            'new or changed.')
+
+    with self.lock:
+      self.db.executemany('DELETE FROM files WHERE path = ?',
+                          ((path,) for path in known))
+      self.commit(len(known))
+
+    p(info, 'Catalog has', n, 'files,', added, 'new or changed,',
+      len(known), 'removed.')
+    return True
+
+  def commit(self, changes=0, force=False):
+    self.changes += changes
+    if force or self.changes >= 1000:
+      self.db.commit()
+      self.changes = 0
+
+  def close(self):
+    with self.lock:
+      self.commit(force=True)
+      self.db.close()
+
+catalog = StateProxy("catalog")
+
+#  ********
+#  open the catalog of the target folder, a new
+#  (empty) catalog or --catalogrefresh walks the
+#  target to bring it up to date
+def initializeCatalog():
+
+  if not settings["catalog"] or not settings["foldertarget"]:
+    return None
+
+  dbfile = settings["catalog"]
+  if dbfile == "default":
+    dbfile = os.path.join(settings["foldertarget"], '.mf2fs_catalog.db')
+
+  try:
+    result = TargetCatalog(dbfile, settings["foldertarget"])
+  except Exception as e:
+    p(critical, 'Catalog', dbfile, 'could not be opened, error', e)
+    raise Mf2fsError('catalog ' + dbfile + ' could not be opened')
+
+  if settings["catalogrefresh"] or len(result) == 0:
+    result.refresh()
+
+  p(info, 'Catalog', dbfile, 'has', len(result), 'files.')
+  return result
+
+#  ********
+#  folder patterns, structure names used in the
+#  json (fileextensions.structure) and their template
+folderPatterns = {
+  "ymd_structure": "{year}/{month}/{day}",
+  "ym_structure": "{year}/{month}",
+  "y_structure": "{year}",
+  "yw_structure": "{isoyear}/W{isoweek}",
+}
+
+# fields that can be used in a folder pattern
+folderPatternFields = ("year", "month", "day", "isoyear", "isoweek",
+                       "category", "extension")
+
+#  ********
+#  compiled folder pattern, target directories are
+#  memoised per key (only the fields the pattern uses)
+#  so files sharing a date share one string and one
+#  existence decision
+class FolderPattern:
+
+  def __init__(self, pattern: str, root: str):
+
+    self.pattern = folderPatterns.get(pattern, pattern)
+    self.root = root
+    self.segments = []
+    self.dirs = {}
+    self.exists = {}
+
+    used = set()
+    for segment in re.split(r'[\\/]+', self.pattern.strip('\\/')):
+      parts = []
+      for literal, field, spec, conv in \
+                  string.Formatter().parse(segment):
+        if literal:
+          parts.append((literal, None))
+        if field is not None:
+          if field not in folderPatternFields:
+            raise ValueError('Unknown field {'+field+'} in folder \
+              pattern '+self.pattern)
+          parts.append((field, spec))
+          used.add(field)
+      if parts:
+        self.segments.append(parts)
+
+    if not used:
+      raise ValueError('Folder pattern '+pattern+' is not a known \
+        structure and has no {fields}')
+
+    self.useDate = bool(used & {"year", "month", "day",
+                                "isoyear", "isoweek"})
+    self.useIso = bool(used & {"isoyear", "isoweek"})
+    self.useCategory = "category" in used
+    self.useExtension = "extension" in used
+
+  #  ********
+  #  the memo key, fields not in the pattern are left out
+  def key(self, date, category=None, extension=None):
+    return (str(date)[0:8] if self.useDate else None,
+            category if self.useCategory else None,
+            extension if self.useExtension else None)
+
+  #  ********
+  #  returns the target directory (or None on a bad date)
+  def targetDir(self, date, category=None, extension=None):
+
+    key = self.key(date, category, extension)
+    try:
+      return self.dirs[key]
+    except KeyError:
+      pass
+
+    values = {"category": category or "None",
+              "extension": extension or "None"}
+    if self.useDate:
+      datestr = key[0]
+      if len(datestr) != 8 or not datestr.isdigit():
+        return None
+      values["year"] = datestr[0:4]
+      values["month"] = datestr[4:6]
+      values["day"] = datestr[6:8]
+      if self.useIso:
+        try:
+          iso = datetime.date(int(datestr[0:4]), int(datestr[4:6]),
+                              int(datestr[6:8])).isocalendar()
+        except ValueError:
+          return None
+        values["isoyear"] = str(iso[0])
+        values["isoweek"] = '%02d' % iso[1]
+
+    dirs = [self.root]
+    for parts in self.segments:
+      segment = ''
+      for text, spec in parts:
+        if spec is None:
+          segment += text
+        else:
+          segment += format(values[text], spec)
+      dirs.append(segment)
+
+    target_dir = self.dirs[key] = os.path.join(*dirs)
+    return target_dir
+
+  #  ********
+  #  one existence check per target directory
+  def isDir(self, target_dir) -> bool:
+    try:
+      return self.exists[target_dir]
+    except KeyError:
+      result = self.exists[target_dir] = dirfds.isdir(target_dir)
+      return result
+
+#  ********
+#  compile the folder patterns once, one per structure
+#  name in use. --folderpattern either names a structure
+#  or is a template that replaces all of them
+def initializeFolderPatterns(extensions) -> dict:
+
+  patterns = {}
+  structures = {item.get("structure") for item in extensions}
+  structures.discard(None)
+  structures.discard('')
+
+  override = settings["folderpattern"]
+  if not override or override == "ymd_structure":
+    override = None
+
+  for structure in structures:
+    try:
+      patterns[structure] = FolderPattern(
+            override if override else structure,
+            settings["foldertarget"])
+    except ValueError as v:
+      p(critical, 'Folder pattern for structure', structure,
+        'could not be compiled, the error is', v)
+      raise Mf2fsError('invalid folder pattern for ' + structure)
+
+  p(verbose, 'Compiled', len(patterns), 'folder pattern(s):',
+    ', '.join(s + ' = ' + patterns[s].pattern for s in patterns))
+
+  return patterns
+
+targetPatterns = StateProxy("targetPatterns")
+
+#  ********
+#  is the file archived under another path in the
+#  target, according to the catalog. if so it is
+#  added to the archived list
+#  > returns True|False
+def archivedElsewhere(row, fileList, archivedFiles) -> bool:
+
+  if not catalog:
+    return False
+
+  hashedvalue = fileList.digest(row)
+  if hashedvalue is None:
+    return False
+
+  source = fileList.path(row)
+  size = fileList.size(row)
+  sourcedigest = None
+  for path in catalog.lookup(hashedvalue, size):
+    if os.path.abspath(path) == os.path.abspath(source):
+      continue
+    try:
+      st = dirfds.stat(path)
+    except OSError:
+      p(verbose, 'Catalog entry', path, 'no longer exists, removed.')
+      catalog.remove(path)
+      continue
+    # hashed again when the signature changed
+    if st.st_size != size or catalog.add(path, st=st) != hashedvalue:
+      continue
+    # the hash is of the head only, the whole
+    # contents decide
+    if sourcedigest is None:
+      sourcedigest = fullHash(source) or ""
+    if not sourcedigest or catalog.digest(path, st) != sourcedigest:
+      continue
+
+    p(verbose, 'File', fileList.name(row), 'is already archived as', 
+      path)
+    archivedFiles.append(row, path)
+    return True
+
+  return False
+
+#  ********
+#  is the target file the source file (the same device
+#  and inode, a hardlink)
+def isLinked(fileList, row, target_file) -> bool:
+
+  inode = fileList.inodes[row]
+  if not inode:
+    return False
+  try:
+    tst = dirfds.stat(target_file)
+    if tst.st_ino != inode or tst.st_nlink < 2:
+      return False
+    return dirfds.stat(fileList.path(row)).st_dev == tst.st_dev
+  except OSError:
+    return False
+
+#  ********
+#  > returns stat of a file in a target folder or None
+def targetStat(target_dir, filename):
+  try:
+    return dirfds.stat(os.path.join(target_dir, filename))
+  except OSError:
+    return None
+
+#  ********
+#  check one file of the filelist against the target
+#  > returns (status, target dir), status is "same",
+#    "different", "rename", "nofolder", "archived" 
+#    (added to archivedFiles) or None (not checked)
+def checkRow(row, fileList, archivedFiles):
+
+  filename = fileList.name(row)
+  filedate = fileList.date(row)
+
+  pattern = targetPatterns.get(fileList.structure(row))
+  if not pattern:
+    return None, None
+
+  # get target folder name, memoised per date (and
+  # category/extension when the pattern uses them)
+  target_dir = pattern.targetDir(filedate, 
+                fileList.category(row), fileList.extension(row))
+  if target_dir is None:
+    p(info,'A date error occured when evaluating the file \
+      date of file', fileList.path(row),'Skipping this one.')
+    return None, None
+
+  if pattern.isDir(target_dir):
+    # dir exists
+    target_file = os.path.join(target_dir,filename)
+    if dirfds.isfile(target_file):
+      p(verbose,'File', filename, 'from date', filedate,
+        'exists in', target_dir)
+      if isLinked(fileList, row, target_file):
+        # the same inode, nothing to compare
+        p(verbose, 'File', filename, 'is linked to', target_file)
+        return "same", target_dir
+      # verify md5 hash
+      if catalog:
+        hashedvalue = catalog.add(target_file)
+      else:
+        hashedvalue = hashfile(target_file)
+      
+      if fileList.digest(row) == hashedvalue:
+        # file is the same
+        return "same", target_dir
+      if archivedElsewhere(row, fileList, archivedFiles):
+        return "archived", target_dir
+      p(verbose,'File', filename, 'from date', filedate, 
+        'exists in', target_dir, 'but has different \
+        hash value')
+      return "different", target_dir
+    if archivedElsewhere(row, fileList, archivedFiles):
+      return "archived", target_dir
+    p(verbose,'File', filename, 'from date', filedate, 
+      'does not exists in', target_dir)
+    return "rename", target_dir
+
+  if archivedElsewhere(row, fileList, archivedFiles):
+    return "archived", target_dir
+  return "nofolder", target_dir
+
+#  ********
+#  check files from filelist against existing files
+#  > returns the plan {"rename", "nofolder", 
+#    "different", "delete", "archived"}
+def planFiles(fileList) -> dict:
+
+  renameFiles = StoreList(fileList, "target")
+  noFolder = []
+  missingFolders = set()
+  existsButDifferent = StoreList(fileList, "target")
+  deleteSourceFile = StoreList(fileList, "date")
+  archivedFiles = StoreList(fileList, "file")
+
+  n=0
+  for row in range(len(fileList)):
+    filename = fileList.name(row)
+    filedate = fileList.date(row)
+
+    if n == 0:
+      p(verbose,'\nEvaluating', len(fileList), 'files \
+        in files list, busy with ', n)
+    n+=1
+
+    status, target_dir = checkRow(row, fileList, archivedFiles)
+    if status == "same":
+      deleteSourceFile.append(row, target_dir, 
+                  targetStat(target_dir, filename))
+    elif status == "different":
+      existsButDifferent.append(row, target_dir)
+    elif status == "rename":
+      renameFiles.append(row, target_dir)
+    elif status == "nofolder":
+      if target_dir not in missingFolders:
+        p(verbose, 'Folder', target_dir, 'for file', filename, \
+          'with date', filedate, 'does not exist.')
+        missingFolders.add(target_dir)
+        noFolder.append((target_dir,))
+      # and add file as well to the list
+      renameFiles.append(row, target_dir)
+    if n==50:
+      n=0
+
+  return {"rename": renameFiles, 
+          "nofolder": noFolder, 
+          "different": existsButDifferent, 
+          "delete": deleteSourceFile, 
+          "archived": archivedFiles}
+
+#  ********
+#  perform the actions of a plan that the settings
+#  ask for (-c, -r, -d)
+def applyPlan(plan):
+
+  noFolder = plan["nofolder"]
+  renameFiles = plan["rename"]
+  deleteSourceFile = plan["delete"]
+
+  if settings["foldercreate"] and len(noFolder)>0:
+    p(info,'Creating folders in ', settings["foldertarget"])
+    doDirCreate(noFolder)
+
+  if settings["link"] and len(renameFiles)>0:
+    p(info,'Linking files into structure \
+      in/under', settings["foldertarget"])
+    renameTheFiles(renameFiles, linkTheFile)
+  elif settings["sourcerename"] and len(renameFiles)>0:
+    p(info,'Renaming (moving) files to structure \
+      in/under', settings["foldertarget"])
+    renameTheFiles(renameFiles)
+
+  if settings["sourcedelete"] and len(deleteSourceFile)>0:
+    p(info,'Deleting source files under', 
+      settings["folderinput"])
+    deleteFiles(deleteSourceFile)
+
+#  ********
+#  check files from filelist against existing files,
+#  report, save and (with -a) act on the plan
+def checkFiles(fileList) -> bool:
+
+  plan = planFiles(fileList)
+  if not reportPlan(plan):
+    return False
 
   if (settings["foldercreate"] or 
     settings["sourcerename"] or 
+    settings["link"] or
     settings["sourcedelete"] ) and \
     not settings["action"]:
       p(info, 'For actions to be performed you *must* include \
         argument "-a"')
   else:
-    if settings["foldercreate"] and len(noFolder)>0:
-      p(info,'Creating folders in ', settings["foldertarget"])
-      doDirCreate(noFolder)
+    applyPlan(plan)
 
-    if settings["sourcerename"] and len(renameFiles)>0:
-      p(info,'Renaming (moving) files to structure \
-        in/under', settings["foldertarget"])
-      renameTheFiles(renameFiles)
+  if len(settings["resultsuse"])>0:
+    currentState().now = settings["resultsuse"]
 
-    if settings["sourcedelete"] and len(deleteSourceFile)>0:
-      p(info,'Deleting source files under', 
-        settings["folderinput"])
-      deleteFiles(deleteSourceFile)
+  return True
 
-  if len(settings["resultsuse"])>0:
-    now=settings["resultsuse"]
+#  ********
+#  show the counts of a plan and save it (--saveresults
+#  stops here, -a continues)
+#  > returns False when the run stops here
+def reportPlan(plan) -> bool:
+
+  renameFiles = plan["rename"]
+  noFolder = plan["nofolder"]
+  existsButDifferent = plan["different"]
+  deleteSourceFile = plan["delete"]
+  archivedFiles = plan["archived"]
+
+  p(info,'')
+  p(info, 'Files that are already present in \
+    target directory:', len(deleteSourceFile))
+  p(info, 'Files that are NOT present in \
+    target directory:', len(renameFiles))
+  p(info, 'Non existing TARGET directories:', len(noFolder))
+  p(info, 'Existing but from source different files (md5 hash) in \
+    TARGET directory:', len(existsButDifferent))
+  if catalog:
+    p(info, 'Files already archived elsewhere in TARGET \
+      (catalog):', len(archivedFiles))
+
+  if settings["resultssave"] or settings["action"]:
+    p(info,'Saving results due to argument --saveresults (exit) or \
+      --action (continue).')
+    if catalog:
+      writeResultsToCsv(archivedFiles, now+"_archivedElsewhere.csv")
+    writeResultsToCsv(deleteSourceFile, now+"_deleteSourceFile.csv")
+    writeResultsToCsv(renameFiles, now+"_renameFiles.csv")
+    writeResultsToCsv(noFolder, now+"_noFolder.csv")
+    writeResultsToCsv(existsButDifferent, now+"_existsButDifferent.csv")
+    searchStats.write(now)
+    if not settings["action"]: 
+      return False
 
   return True
 
@@ -566,145 +3006,762 @@ def is_date(string, fuzzy=False):
     return False
 
 #  ********
-#  return datetime object
+#  return datetime object from a date in a filename
+def getDateFromName(filename: str):
+
+  datepatterns = [(r'\d{4}-\d{2}-\d{2}','%Y-%m-%d'), 
+          (r'\d{4}\d{2}\d{2}','%Y%m%d'),
+          (r'\d{2}\d{2}\d{4}','%d%m%Y'),
+          (r'\d{2}\d{2}\d{4}','%m%d%Y'),
+          (r'\d{2}-d{2}-d{4}','%m-%d-%Y')]
+
+  for r in datepatterns:
+    try:
+      datepattern = re.search(r[0], filename)
+      if datepattern: 
+        if is_date(datepattern.group()):
+          return datetime.datetime.strptime(
+              datepattern.group(), r[1]).date()
+
+    except ValueError as v:
+      pass
+      
+    except AttributeError as a:
+      pass
+
+  return None
+
+#  ********
+#  return date string and the source of the date
+#  ("filename" or "mtime")
 def getDateFromFilename(filepath: str):
 
   dt = datetime.datetime.now()
   skip = False
 
-  if os.path.isfile(filepath):
+  if dirfds.isfile(filepath):
     try:
       file_path, filename = os.path.split(filepath)
 
     except Exception as e:
       p(error, 'Unable to get filename from', filepath, 
           'The received error is', e)
-      return None
+      return None, None
 
-    datepatterns = [(r'\d{4}-\d{2}-\d{2}','%Y-%m-%d'), 
-            (r'\d{4}\d{2}\d{2}','%Y%m%d'),
-            (r'\d{2}\d{2}\d{4}','%d%m%Y'),
-            (r'\d{2}\d{2}\d{4}','%m%d%Y'),
-            (r'\d{2}-d{2}-d{4}','%m-%d-%Y')]
+    name_date = getDateFromName(filename)
+    if name_date:
+      skip = True
+      dt = name_date
 
-    for r in datepatterns:
+    if not skip:
       try:
-        datepattern = re.search(r[0], filename)
-        if datepattern: 
-          if is_date(datepattern.group()):
-            skip = True
-            dt = datetime.datetime.strptime(
-                datepattern.group(), r[1]).date()
-            break
+        dt = datetime.datetime.fromtimestamp(
+              dirfds.stat(filepath).st_mtime)
+              
+      except Exception as f:
+        p(error, 'Unable to get system date from file.\
+          Do you have enough rights to read the file? \
+          The respons was', f)
+        return None, None
+
+    dt = datetime.datetime.strftime(dt, '%Y%m%d')
+    
+    return dt, "filename" if skip else "mtime"
+
+  return None, None
+
+#  ********
+#  to do, move properties to json config
+def getMovieProperties(filepath: str):
+
+  # the media properties are only available on windows
+  if propsys is None:
+    return getDateFromFilename(filepath)
+
+  dt = datetime.datetime.now()
+
+  try:
+    properties = propsys.SHGetPropertyStoreFromParsingName(filepath)
+    dt = properties.GetValue(pscon.PKEY_Media_DateEncoded).GetValue()
+
+    if not isinstance(dt, datetime.datetime): 
+      if not isinstance(dt, type(None)):
+        dt = datetime.datetime.fromtimestamp(int(dt))
+        dt = dt.replace(tzinfo=pytz.timezone('UTC'))
+
+  except Exception as e:
+    p(warning,'File',filepath,'could not be poked for date creation',e)
+    pass
+
+  if dt == None:
+    return getDateFromFilename(filepath)
+
+  return dt, "video"
+
+#  ********
+#  date string from the first of the date tags found
+#  in the exif tags, tags can be given comma separated
+#  as in the json (creationdateproperties)
+def getExifDate(tags, date_taken_tags):
+
+  date_taken = None
+  for tag in (t.strip() for item in date_taken_tags 
+                        for t in str(item).split(',')):
+    if tag in tags:
+      date_taken = tags[tag]
+      break
+
+  if str(date_taken).find(':') > 0:
+    try:
+      date_taken = re.search(r'\d{4}:\d{2}:\d{2}', str(date_taken))
+      date_taken = datetime.datetime.strptime(
+              date_taken.group(), '%Y:%m:%d').date()
+      return datetime.datetime.strftime(date_taken,'%Y%m%d')
+    except Exception as e:
+      p(warning,'Following error while evaluating EXIF data\n', 
+        type(date_taken), date_taken, '\n', e)
 
+  return None
+
+#  ********
+#  exif date of a file, from the head when read 
+#  > returns date string or None
+def getExifDateOfFile(filepath, date_taken_tags, reader=None):
+
+  try:
+    if reader:
+      # the head is already read, exifread
+      # only reads more when it needs to
+      reader.seek(0)
+      tags = exifread.process_file(reader)
+    else:
+      begin = time.monotonic()
+      file = dirfds.open(filepath)
+      tags = exifread.process_file(file)
+      ioDone(filepath, file.tell(), begin)
+      file.close()
+
+  except Exception as e:
+    p(verbose, '\t\tCould not read exif data file, error', e)
+    return None
+
+  return getExifDate(tags, date_taken_tags)
+
+#  ********
+#  success of the date extractors (exif, filename) per
+#  extension. an extractor that (almost) never yields 
+#  a date for an extension is skipped, one that often 
+#  fails is tried after the others. skipped extractors
+#  are tried again now and then (re-probing), so the
+#  policy follows changes in the files. kept between 
+#  runs in a json file (--extractorstate)
+class ExtractorStats:
+
+  # tries before an extractor is judged
+  minTries = 20
+  # success rates below which it is skipped / demoted
+  skipRate = 0.02
+  demoteRate = 0.5
+  # a skipped extractor is tried once every .. files
+  probeEvery = 50
+  # counters are halved above this, old results fade
+  maxTries = 1000
+
+  def __init__(self, statefile: str = None):
+
+    self.statefile = statefile
+    # extension > extractor > [tries, successes, skipped]
+    self.data = {}
+    self.lock = threading.Lock()
+    if statefile and os.path.isfile(statefile):
+      try:
+        with open(statefile, 'r') as input:
+          self.data = json.load(input)
+      except Exception as e:
+        p(warning, 'Extractor state', statefile, 'not read, error', e)
+
+  def rate(self, counter) -> float:
+    return counter[1] / counter[0] if counter[0] else 1.0
+
+  #  ********
+  #  > returns the extractors to try, in order
+  def order(self, extension, extractors) -> list:
+
+    result, demoted = [], []
+    with self.lock:
+      stats = self.data.get(extension, {})
+      for extractor in extractors:
+        counter = stats.get(extractor)
+        if counter is None or counter[0] < self.minTries:
+          result.append(extractor)
+        elif self.rate(counter) < self.skipRate:
+          counter[2] += 1
+          if counter[2] % self.probeEvery == 0:
+            result.append(extractor)
+        elif self.rate(counter) < self.demoteRate:
+          demoted.append(extractor)
         else:
-          pass
+          result.append(extractor)
+    return result + demoted
+
+  #  ********
+  #  one try of an extractor
+  def record(self, extension, extractor, success: bool):
+
+    with self.lock:
+      counter = self.data.setdefault(extension, {}).setdefault(
+                                          extractor, [0, 0, 0])
+      counter[0] += 1
+      counter[1] += 1 if success else 0
+      if counter[0] > self.maxTries:
+        counter[0] //= 2
+        counter[1] //= 2
+
+  #  ********
+  #  > returns [(extension, extractor, tries, rate, 
+  #    skipped)] of the extractors that are skipped
+  def skipped(self) -> list:
+    with self.lock:
+      return [(extension, extractor, counter[0], 
+               round(self.rate(counter), 3), counter[2])
+              for extension, stats in sorted(self.data.items())
+              for extractor, counter in stats.items()
+              if counter[0] >= self.minTries and 
+                 self.rate(counter) < self.skipRate]
+
+  def save(self):
+
+    if not self.statefile:
+      return
+    try:
+      with self.lock:
+        with open(self.statefile, 'w') as output:
+          json.dump(self.data, output, indent=1, sort_keys=True)
+    except Exception as e:
+      p(warning, 'Extractor state', self.statefile, 
+        'not saved, error', e)
+
+#  ********
+#  statistics of the date extractors
+def initializeExtractors():
+
+  statefile = settings["extractorstate"]
+  if statefile == "default":
+    statefile = os.path.join(settings["foldertarget"] or '.', 
+                             '.mf2fs_extractors.json')
+  return ExtractorStats(statefile or None)
+
+extractors = StateProxy("extractors")
+
+#  ********
+#  to do, check on difference between modifiedDate
+#  and createDate. less is more.
+#  > returns (date, source of the date)
+def getCreationDateInfo(filepath, cat_mst, *cat_cdp, reader=None,
+                        extension=None):
+
+  source = None
+  # given as one argument (the creation date properties)
+  if len(cat_cdp) == 1:
+    cat_cdp = cat_cdp[0]
+
+  if cat_cdp not in ("filesystem", "video"):
+
+    date_taken_tags = [item for item in cat_cdp] \
+                      if isinstance(cat_cdp, tuple) else [cat_cdp]
+    p(allmsg,'Using create date category', date_taken_tags, \
+              'for file with master category', cat_mst)
+
+    # extractors in the order that works for the extension,
+    # the filename (with the mtime as fallback) is last
+    # unless exif seldom works for the extension
+    date_taken = None
+    for extractor in extractors.order(extension, ("exif", "filename")):
+      if extractor == "exif":
+        found = getExifDateOfFile(filepath, date_taken_tags, reader)
+        extractors.record(extension, "exif", found is not None)
+        if found:
+          date_taken, source = found, "exif"
+          break
+      else:
+        date_taken, source = getDateFromFilename(filepath)
+        extractors.record(extension, "filename", source == "filename")
+        if source == "filename":
+          break
+
+    if date_taken == None:
+      date_taken, source = getDateFromFilename(filepath)
+  
+  elif cat_cdp == "filesystem":
+    date_taken, source = getDateFromFilename(filepath)
+    
+  elif cat_cdp == "video":
+    date_taken, source = getMovieProperties(filepath)
+
+  return date_taken, source
 
-      except ValueError as v:
-        pass
-        
-      except AttributeError as a:
-        pass
+#  ********
+#  archives that can be read as streams, members are
+#  addressed as <archive path>::<member name>
+archiveTypes = {".zip": "zip", ".cbz": "zip", ".tar": "tar", 
+                ".tgz": "tar", ".tar.gz": "tar", ".tbz2": "tar", 
+                ".tar.bz2": "tar", ".txz": "tar", ".tar.xz": "tar"}
+archiveMarker = '::'
 
-    if not skip:
-      try:
-        dt = datetime.datetime.fromtimestamp(
-              os.path.getmtime(filepath))
-              
-      except Exception as f:
-        p(error, 'Unable to get system date from file.\
-          Do you have enough rights to read the file? \
-          The respons was', f)
-        return None
+#  ********
+#  > returns "zip", "tar" or None
+def archiveType(filename: str):
+  name = filename.lower()
+  for extension, kind in archiveTypes.items():
+    if name.endswith(extension):
+      return kind
+  return None
 
-    dt = datetime.datetime.strftime(dt, '%Y%m%d')
-    
-    return dt
+#  ********
+#  > returns (archive path, member name) or None
+def splitArchivePath(path: str):
+
+  idx = path.find(archiveMarker)
+  while idx >= 0:
+    if archiveType(path[:idx]):
+      member = path[idx+len(archiveMarker):].replace('\\', '/')
+      return path[:idx], member.lstrip('/')
+    idx = path.find(archiveMarker, idx+1)
+  return None
 
 #  ********
-#  to do, move properties to json config
-def getMovieProperties(filepath: str):
+#  stream of one member of a zip archive (members of
+#  a tar are hashed in one pass, see tarDigests)
+@contextlib.contextmanager
+def memberStream(archivepath: str, member: str):
 
-  dt = datetime.datetime.now()
+  with zipfile.ZipFile(archivepath) as archive:
+    with archive.open(member) as stream:
+      yield stream
 
-  try:
-    properties = propsys.SHGetPropertyStoreFromParsingName(filepath)
-    dt = properties.GetValue(pscon.PKEY_Media_DateEncoded).GetValue()
+#  ********
+#  md5 of the whole contents of every member of a tar
+#  archive, a tar can only be read from the start so 
+#  all members are hashed in the pass for the first 
+#  member asked for (cached per job). members after a
+#  read error are missing
+#  > returns dict member name > hash
+memberDigests = StateProxy("memberDigests")
 
-    if not isinstance(dt, datetime.datetime): 
-      if not isinstance(dt, type(None)):
-        dt = datetime.datetime.fromtimestamp(int(dt))
-        dt = dt.replace(tzinfo=pytz.timezone('UTC'))
+def tarDigests(archivepath: str) -> dict:
 
-  except Exception as e:
-    p(warning,'File',filepath,'could not be poked for date creation',e)
+  try:
+    return memberDigests[archivepath]
+  except KeyError:
     pass
 
-  if dt == None:
-    dt = getDateFromFilename(filepath)
+  digests = {}
+  total = 0
+  begin = time.monotonic()
+  try:
+    with tarfile.open(archivepath, 'r|*') as archive:
+      for info in archive:
+        if not info.isfile():
+          continue
+        digest = hashlib.md5()
+        stream = archive.extractfile(info)
+        while True:
+          chunk = stream.read(1024*1024)
+          if not chunk:
+            break
+          digest.update(chunk)
+          total += len(chunk)
+        digests[info.name.lstrip('/')] = digest.hexdigest()
+  except Exception as e:
+    p(warning, 'Couldn\'t read all of', archivepath, 'error', e)
 
-  return dt
+  ioDone(archivepath, total, begin)
+  memberDigests[archivepath] = digests
+  return digests
 
 #  ********
-#  to do, check on difference between modifiedDate
-#  and createDate. less is more.
-def getCreationDateInfo(filepath, cat_mst, *cat_cdp):
+#  > returns the date of a zip or tar member, or None
+#  when the header has no valid date
+def memberDate(info):
 
-  skip = False
+  try:
+    if isinstance(info, zipfile.ZipInfo):
+      return datetime.datetime(*info.date_time)
+    return datetime.datetime.fromtimestamp(info.mtime)
+  except (ValueError, TypeError, OverflowError, OSError):
+    return None
 
-  if not cat_cdp == "filesystem":
+#  ********
+#  index the members of a zip or tar archive as 
+#  streams, only the head of media members is read
+#  (for the hash and exif). tar archives are read in
+#  one pass, so memory use does not depend on the
+#  size of the archive
+#  > returns [(record, stats), ...]
+def indexArchive(filepath: str) -> list:
+
+  results = []
+  kind = archiveType(filepath)
+  begin = time.monotonic()
+  try:
+    if kind == "zip":
+      with zipfile.ZipFile(filepath) as archive:
+        for member in archive.infolist():
+          if member.is_dir():
+            continue
+          headerdate = memberDate(member)
+          if headerdate is None:
+            p(warning, 'Member', member.filename, 'of', filepath, 
+              'has an invalid date', member.date_time, 'skipped.')
+            continue
+          results.append(indexMember(filepath, member.filename,
+                    member.file_size, headerdate,
+                    lambda: archive.open(member)))
+    else:
+      with tarfile.open(filepath, 'r|*') as archive:
+        for member in archive:
+          if not member.isfile():
+            continue
+          headerdate = memberDate(member)
+          if headerdate is None:
+            p(warning, 'Member', member.name, 'of', filepath, 
+              'has an invalid date', member.mtime, 'skipped.')
+            continue
+          results.append(indexMember(filepath, member.name,
+                    member.size, headerdate,
+                    lambda: archive.extractfile(member)))
+  except Exception as e:
+    p(error, 'Reading archive', filepath, 'failed with error', e)
 
-    date_taken_tags = [item for item in cat_cdp]
-    p(allmsg,'Using create date category', date_taken_tags, \
-              'for file with master category', cat_mst)
+  ioDone(filepath, 0, begin)
+  p(verbose, '\t\tarchive', filepath, 'has', len(results), 'members.')
+  return results
 
+#  ********
+#  record and stats of one archive member, opener
+#  returns the member stream
+def indexMember(archivepath, name, size, headerdate, opener):
+
+  filename = name.split('/')[-1]
+  file_extension = filename.split('.')[-1:][0].lower() if \
+                      sys.platform == 'win32' \
+                      else filename.split('.')[-1:][0]
+  ext_action, ext_struct, ext_cat, cat_mst, cat_cdp = \
+          classify(file_extension, filename)
+
+  if ext_action != "moveIntoTarget" or not ext_struct:
+    # only counted
+    return None, (file_extension, ext_cat, ext_action, size, None)
+
+  # bounded read, the head only
+  with opener() as stream:
+    head = stream.read(HeadReader.headsize)
+  hashedvalue = hashlib.md5(head[:8196]).hexdigest()
+
+  date_taken = None
+  source = None
+  if cat_cdp and cat_cdp not in ("filesystem", "video"):
     try:
-      file = open(filepath, 'rb')
-      tags = exifread.process_file(file)
-      file.close()
-
+      date_taken = getExifDate(exifread.process_file(io.BytesIO(head)),
+                               [cat_cdp])
+      source = "exif" if date_taken else None
     except Exception as e:
-      p(verbose, '\t\tCould not read exif data file, error', e)
-      skip = True
+      p(verbose, '\t\tCould not read exif data of member', name, e)
 
-    date_taken = None
-    if not skip:
-      for tag in date_taken_tags:
-        if tag in tags:
-          date_taken = tags[tag]
-          break
+  if not date_taken:
+    name_date = getDateFromName(filename)
+    if name_date:
+      date_taken, source = name_date.strftime('%Y%m%d'), "filename"
+    else:
+      date_taken, source = headerdate.strftime('%Y%m%d'), "header"
+
+  p(allmsg, 'Archive member', name, date_taken, source)
+  return (hashedvalue,
+          archivepath + archiveMarker + '/' + name.lstrip('/'),
+          filename,
+          date_taken,
+          ext_struct,
+          ext_cat,
+          file_extension,
+          size,
+          int(headerdate.timestamp() * 1e9),
+          0), (file_extension, ext_cat, ext_action, size, source)
 
-    if str(date_taken).find(':') > 0:
+#  ********
+#  write members of an archive into their target 
+#  files, streamed from the archive without a 
+#  temporary extraction. tar archives in one pass
+#  wanted = [(member name, target file), ...]
+#  > returns number of written members
+def materializeArchive(archivepath, wanted) -> int:
+
+  targets = {}
+  for member, target in wanted:
+    targets.setdefault(member, []).append(target)
+
+  def write(stream, member, mtime):
+    written = 0
+    for target in targets.pop(member, []):
+      begin = time.monotonic()
       try:
-        date_taken = re.search(r'\d{4}:\d{2}:\d{2}', str(date_taken))
-        date_taken = datetime.datetime.strptime(
-                date_taken.group(), '%Y:%m:%d').date()
-        date_taken = datetime.datetime.strftime(date_taken,'%Y%m%d')
+        if written:
+          dirfds.copy(targets_done[member], target)
+        else:
+          with dirfds.open(target, 'wb') as dst:
+            copyThrottled(stream, dst, archivepath, target)
+          ioDone(archivepath, 0, begin)
+          ioDone(target)
+          targets_done[member] = target
+        if mtime is not None:
+          begin = time.monotonic()
+          dirfds.utime(target, (mtime, mtime))
+          ioDone(target, 0, begin)
+        if catalog:
+          catalog.add(target)
+        written += 1
       except Exception as e:
-        p(warning,'Following error while evaluating EXIF data\n', 
-          type(date_taken), date_taken, '\n', e)
-        date_taken = None
+        p(error, 'Writing member', member, 'of', archivepath, 'to',
+          target, 'failed with error', e)
+    return written
 
-    if date_taken == None:
-      date_taken = getDateFromFilename(filepath)
-  
-  elif cat_cdp == "filesystem":
-    date_taken = getDateFromFilename(filepath)
-    
-  elif cat_cdp == "video":
-    date_taken = getMovieProperties(filepath)
+  targets_done = {}
+  done = 0
+  try:
+    if archiveType(archivepath) == "zip":
+      with zipfile.ZipFile(archivepath) as archive:
+        for member in list(targets):
+          info = archive.getinfo(member)
+          date = memberDate(info)
+          with archive.open(info) as stream:
+            done += write(stream, member, 
+                          date.timestamp() if date else None)
+    else:
+      with tarfile.open(archivepath, 'r|*') as archive:
+        for info in archive:
+          if not targets:
+            break
+          if info.name in targets:
+            done += write(archive.extractfile(info), info.name, 
+                          info.mtime)
+  except Exception as e:
+    p(error, 'Reading archive', archivepath, 'failed with error', e)
+
+  for member in targets:
+    p(error, 'Member', member, 'not found in', archivepath)
+
+  return done
+
+#  ********
+#  the folders to walk
+#  > returns [(path, recurse), ...]
+def walkRoots() -> list:
+
+  p(info, 'Searching for files in', '"'+settings["folderinput"]+'"', 
+    'and folderssub' if settings["folderssub"] else '')
+
+  if settings["shard"] and settings["shardby"] == "subtree":
+    # only walk the top level folders of this shard,
+    # the files of the input folder itself are listed
+    roots = [(settings["folderinput"], False)]
+    for folder in getListOfFiles(settings["folderinput"], True):
+      if inShard(folder.path, True):
+        roots.append((folder.path, True))
+    p(info, 'Shard', '%d/%d' % settings["shard"], 'has', 
+      len(roots)-1, 'top level folder(s).')
+  else:
+    roots = [(settings["folderinput"], True)]
+
+  return roots
+
+#  ********
+#  walk the input folder(s), the files are yielded while
+#  the walk goes on so the whole tree is never held
+#  > yields DirEntry objects (files)
+def walkFiles():
+
+  roots = walkRoots()
+
+  # folders are listed concurrently, on network shares
+  # the walk is bound by the latency of each listing
+  walker = TreeWalker(settings["walkthreads"])
+  folders = walker.walk(roots)
+  limit = int(settings["number"])
+  begin = time.monotonic()
+  a=0
+  n=0
+  p(info, '')
+  try:
+    for folder, filesInFolder in folders:
+      a+=1
+      p(info, 'Processing folder', folder)
+      if settings["shard"]:
+        filesInFolder = [f for f in filesInFolder if inShard(f.path)]
+      p(info, '\t... total of', len(filesInFolder), 'files found. \
+        Another', walker.pending, 'folders queued.')
+      for file in filesInFolder:
+        yield file
+        n+=1
+        if limit > 0 and n >= limit:
+          return
+  finally:
+    folders.close()
+    p(info,'Listed', a, 'folders with', walker.workers, 'thread(s) in', 
+      round(time.monotonic() - begin, 2), 'seconds.')
 
-  return date_taken
+#  ********
+#  estimate of a full run from a sample, the tree is
+#  walked (names and stat only), per extension a 
+#  sample is processed and checked against the target.
+#  totals are extrapolated per extension (stratified),
+#  with a 95% confidence interval
+def estimateRun():
+
+  z = 1.96
+  margin = settings["estimate"]
+  # sample size for a proportion (p = 0.5) within the
+  # margin, with finite population correction
+  n0 = z * z * 0.25 / (margin * margin)
+  reservoir = math.ceil(n0)
+  begin = time.monotonic()
+
+  # per extension [reservoir sample, files, bytes], the
+  # sample is never larger than n0 so only that many
+  # entries per extension are kept while walking
+  strata = {}
+  for file in walkFiles():
+    try:
+      if not file.is_file():
+        continue
+      size = file.stat().st_size
+    except OSError:
+      continue
+    extension = file.name.split('.')[-1:][0]
+    if sys.platform == 'win32':
+      extension = extension.lower()
+    stratum = strata.setdefault(extension, [[], 0, 0])
+    stratum[1] += 1
+    stratum[2] += size
+    if len(stratum[0]) < reservoir:
+      stratum[0].append(file)
+    else:
+      i = random.randrange(stratum[1])
+      if i < reservoir:
+        stratum[0][i] = file
+  walktime = time.monotonic() - begin
+
+  sample = []
+  for extension, (entries, count, nbytes) in strata.items():
+    n = min(count, math.ceil(n0 / (1 + (n0 - 1) / count)))
+    sample.extend(random.sample(entries, n))
+  nfiles = sum(count for entries, count, nbytes in strata.values())
+  nbytes = sum(nbytes for entries, count, nbytes in strata.values())
+  p(info, 'Walked', nfiles, 'files in', round(walktime, 2), 
+    'seconds, sampling', len(sample), 'files of', len(strata), 
+    'extension(s).')
+
+  def timedProcess(file):
+    start = time.monotonic()
+    result = processFile(file)
+    return file, result, time.monotonic() - start
+
+  # per extension: [seconds, files to move, bytes to 
+  # move, duplicates] per sampled file
+  measured = {extension: [] for extension in strata}
+  fileList = FileStore()
+  archivedFiles = StoreList(fileList, "file")
+  # the sampled files are checked a chunk at a time, so
+  # the dates by mtime (fillDates) are taken at once
+  def settle(chunk):
+    records = dateRecords([record for file, records, seconds in chunk
+                                  for record in records])
+    for file, files, seconds in chunk:
+      extension = file.name.split('.')[-1:][0]
+      if sys.platform == 'win32':
+        extension = extension.lower()
+      move, moved, duplicate = 0, 0, 0
+      for record in records[:len(files)]:
+        status = "rename"
+        if settings["foldertarget"]:
+          fileList.append(record)
+          status, target_dir = checkRow(len(fileList)-1, fileList, 
+                                        archivedFiles)
+        if status in ("rename", "nofolder"):
+          move, moved = 1, record[7] or 0
+        elif status in ("same", "archived"):
+          duplicate = 1
+      del records[:len(files)]
+      measured[extension].append((seconds, move, moved, duplicate))
+
+  scheduler = DeviceScheduler(settings["iothreads"])
+  start = time.monotonic()
+  chunk = []
+  for timed in scheduler.run(sample, timedProcess):
+    if timed is None:
+      # failed, see DeviceScheduler
+      continue
+    file, result, seconds = timed
+    # members of archives are not sampled
+    chunk.append((file, [record for record, stats in result or [] 
+                         if record is not None and 
+                            record[1] == file.path], seconds))
+    if len(chunk) >= 256:
+      settle(chunk)
+      chunk = []
+  settle(chunk)
+  sampletime = time.monotonic() - start
+  worktime = sum(m[0] for values in measured.values() for m in values)
+  parallel = max(1.0, worktime / sampletime) if sampletime else 1.0
+
+  def total(index):
+    value, variance = 0.0, 0.0
+    for extension, values in measured.items():
+      if not values:
+        continue
+      size, n = strata[extension][1], len(values)
+      mean = sum(v[index] for v in values) / n
+      var = sum((v[index] - mean) ** 2 for v in values) / (n - 1) \
+              if n > 1 else 0.0
+      value += size * mean
+      variance += size * size * (1 - n / size) * var / n
+    return value, z * math.sqrt(variance)
+
+  rows = [("files", nfiles, nfiles, nfiles),
+          ("bytes", nbytes, nbytes, nbytes)]
+  for name, index in (("files to move", 1), ("bytes to move", 2), 
+                      ("duplicates", 3)):
+    value, delta = total(index)
+    rows.append((name, round(value), round(max(0, value - delta)), 
+                 round(value + delta)))
+  value, delta = total(0)
+  rows.append(("seconds", round(walktime + value / parallel, 1),
+               round(walktime + max(0, value - delta) / parallel, 1),
+               round(walktime + (value + delta) / parallel, 1)))
+  if nfiles:
+    duplicates = rows[-2]
+    rows.append(("duplicate rate", round(duplicates[1] / nfiles, 4),
+                 round(duplicates[2] / nfiles, 4),
+                 round(duplicates[3] / nfiles, 4)))
+
+  p(info, 'Estimate (95% confidence interval) from a sample of', 
+    len(sample), 'files in', round(time.monotonic() - begin, 2), 
+    'seconds:')
+  for name, value, low, high in rows:
+    p(info, '\t' + name + ':', value, '(' + str(low), '-', 
+      str(high) + ')')
+  writeResultsToCsv([("metric", "estimate", "low", "high")] + rows,
+                    now+"_estimate.csv")
+
+  return rows
 
 #  ********
 #  returns list of DirEntry object
-def getListOfFiles(dirName):
-  # create a list of files 
+def getListOfFiles(dirName, folders=False):
+  # create a list of files (or folders)
   # from the given directory 
   listOfFiles = []
   try:
-    for entry in os.scandir(dirName):
-      if entry.is_file():
+    for entry in dirfds.scandir(dirName):
+      if entry.is_dir() if folders else entry.is_file():
         listOfFiles.append(entry)
   except Exception as e:
     p(error, e)
@@ -712,156 +3769,225 @@ def getListOfFiles(dirName):
   return listOfFiles
 
 #  ********
-#  returns list of DirEntry object
-#  hmm, where is the --subfolder switch?
-def getListOfFolders(dirName, listOfFolder):
-  # create a list of sub directories 
-  # names in the given directory 
-  p(allmsg,dirName)
-  try:    
-    for entry in os.scandir(dirName):
-      if entry.is_dir():
-        listOfFolder.append(os.path.join(entry))
-        listOfSubdirs = getListOfFolders(entry,listOfFolder)
+#  action, structure, category, master category and
+#  creation date properties of an extension, memoised
+#  per extension
+extensionClasses = StateProxy("extensionClasses")
+
+def classify(file_extension, filename):
+
+  if file_extension in extensionClasses:
+    return extensionClasses[file_extension]
+
+  # get record file_extension
+  ext_ext, ext_action, ext_struct, ext_cat = \
+          getRecord(extlodext, "extension", file_extension)
+  
+  # get_record category
+  cat_cat, cat_cdp, cat_cdc, cat_fbc = \
+          getRecord(extlodext, "category", ext_cat)
+  
+  try:
+    cat_mst, cat_cdp = getRecord(extlodext, "master", cat_cat)
   except Exception as e:
-    p(error, e)
+    p(critical,'The following warning occured during the category\
+                search for file', filename, e, 'Defaults will be\
+                applied (leaveCount, Undefined extensions).')
+    ext_action = "leaveCount"
+    ext_cat = "Undefined extensions"
+    cat_mst = "Anything else"
+    cat_cdp = "filesystem"
+
+  extensionClasses[file_extension] = \
+          ext_action, ext_struct, ext_cat, cat_mst, cat_cdp
+  return ext_action, ext_struct, ext_cat, cat_mst, cat_cdp
+
+# hash and date per (device, inode, size, mtime) of the
+# files with more than one link
+linkedFiles = StateProxy("linkedFiles")
+
+# names without these can't hold a date (getDateFromName)
+dateInName = re.compile(r'\d{4}-\d{2}-\d{2}|\d{8}')
 
-  return listOfFolder
+#  ********
+#  gather the info of one file (DirEntry), called
+#  from the device scheduler threads
+#  > returns [(record, (extension, category, action,
+#    size, date source)), ...] | None, with --archives
+#    the members of an archive follow the archive
+def processFile(file):
+
+  donotInclude = False
+  skip = False
+  date_taken = datetime.datetime.now()
+  date_source = None
+
+  if not file.is_file():
+    return None
+
+  filename = file.name
+  filepath = file.path
+  p(verbose, '\t\tprocessing file', filename)
+  file_extension = filename.split('.')[-1:][0].lower() if \
+                      sys.platform == 'win32' \
+                      else filename.split('.')[-1:][0]
+  p(allmsg,'File:', filename, 'Path:', \
+                   filepath, 'Ext:', file_extension)
+
+  ext_action, ext_struct, ext_cat, cat_mst, cat_cdp = \
+          classify(file_extension, filename)
+
+  if ext_action != "moveIntoTarget":
+    # leaveCount and unknown extensions are only counted,
+    # from the name and the (cached) stat, never opened
+    try:
+      filesize = file.stat().st_size
+    except OSError:
+      filesize = None
+    results = [(None, (file_extension, ext_cat, ext_action, filesize, 
+                       None))]
+    if settings["archives"] and archiveType(filename):
+      results += indexArchive(filepath)
+    return results
+
+  try:
+    st = file.stat()
+    filesize, mtime, inode = st.st_size, st.st_mtime_ns, file.inode()
+  except OSError:
+    st = None
+    filesize, mtime, inode = None, None, None
+
+  # a file with more links is read once, the other
+  # paths of the same inode share its hash and date
+  linkkey = (st.st_dev, inode, filesize, mtime) \
+            if st and st.st_nlink > 1 and inode else None
+  known = linkedFiles.get(linkkey) if linkkey else None
+  if known:
+    p(verbose, '\t\tfile', filename, 'is a link of', known[0])
+    path, hashedvalue, date_taken, date_source = known
+    stats = (file_extension, ext_cat, ext_action, filesize, date_source)
+    return [((hashedvalue, filepath, filename, date_taken, ext_struct,
+              ext_cat, file_extension, filesize, mtime, inode), stats)]
+
+  # one open, the head for the hash is read and only
+  # extended when an extractor (exif) reads beyond it
+  try:
+    reader = HeadReader(filepath)
+  except Exception as e:
+    p(warning, 'Couldn\'t read file', filepath, 'error', e)
+    reader = None
+  hashedvalue = hashfile(filepath, reader)
+  
+  if ext_struct == None:
+    p(error,"Structure definition not defined for ", file_extension, \
+            "not including file in results", filename)
+    skip = False
+    donotInclude = True
+
+  if not skip and cat_cdp == "filesystem" and \
+     not dateInName.search(filename):
+    # the date is the mtime, filled in for all these
+    # files at once after the search (fillDates)
+    date_taken, date_source = None, "mtime"
+    skip = True
+
+  if not skip:
+    try:
+      p(allmsg,'Getting file info', filename)
+      date_taken, date_source = getCreationDateInfo(filepath, 
+                                        cat_mst, cat_cdp, reader=reader,
+                                        extension=file_extension)
+      skip = True
+
+    except Exception as v:
+      p(error, "Something went wrong. The error is in the data", v)
+
+  if reader:
+    if reader.extra:
+      p(allmsg, 'Extra reads beyond the head', reader.extra, filename)
+    reader.close()
+
+  if skip:
+    p(allmsg,filename,date_taken)
+
+  stats = (file_extension, ext_cat, ext_action, filesize, date_source)
+  if linkkey and not donotInclude:
+    linkedFiles[linkkey] = (filepath, hashedvalue, date_taken, 
+                            date_source)
+  if donotInclude:
+    results = [(None, stats)]
+  else:
+    results = [((hashedvalue, 
+                 filepath, 
+                 filename,
+                 date_taken,
+                 ext_struct,
+                 ext_cat,
+                 file_extension,
+                 filesize,
+                 mtime,
+                 inode), stats)]
+
+  if settings["archives"] and archiveType(filename):
+    results += indexArchive(filepath)
+
+  return results
 
 #  ********
 #  do the search for files per folder
-def performSearch():
+def scanFiles():
   # stage one, gather files
   # and info
   
-  global searchResults
-  
-  fileList = []
-  folderList = []
-  listOfFolders = []
-
-  p(info, 'Searching for files in', '"'+settings["folderinput"]+'"', 
-    'and folderssub' if settings["folderssub"] else '')
+  fileList = FileStore()
 
-  listOfFolders = getListOfFolders(settings["folderinput"],
-                  [settings["folderinput"]])
+  # files are read per device in inode order (within a
+  # window of the walk), each device with its own 
+  # number of concurrent reads
+  scheduler = DeviceScheduler(settings["iothreads"])
 
-  if len(listOfFolders) <= 1:
-    listOfFolders.append(settings["folderinput"])
-    listOfFolders=removeDuplicates(listOfFolders)
+  b, t, n = 0, 0, 0
+  begin = time.time()
+  for result in scheduler.run(walkFiles(), processFile):
+    t+=1
+    n+=1
+    if result is None:
+      b+=1
+    else:
+      for record, stats in result:
+        searchStats.add(*stats)
+        if record:
+          fileList.append(record)
 
-  p(info,'Found', len(listOfFolders), 'folders to process.')
+    if n==50:
+      end = time.time() 
+      elapsed_time = round(end - begin, 2)   
+      p(info,'\t\t... checked', t, 'files', 
+        '('+ str(b),'files skipped),', 
+        round(n/elapsed_time, 1) if elapsed_time else n, 
+        'files per second.')
+      begin = time.time()
+      n=0
 
-  a=0
-  print()
-  for folder in listOfFolders:
-    a+=1
-    p(info, 'Processing folder', folder)
-    filesInFolder = getListOfFiles(folder)
-    p(info, '\t... total of', len(filesInFolder), 'files found. \
-      After this one another', len(listOfFolders)-a, 'folders to go.')
-
-    b, t, n = 0
-    begin = time.time()
-    for file in filesInFolder:
-      p(verbose, '\t\tprocessing file', file.name, 'as', t, 'of',
-        len(filesInFolder))
-      donotInclude = False
-      skip = False
-      date_taken = datetime.datetime.now()
-      
-      if not file.is_file:
-        foundFile = False
-      else:
-        foundFile = True
+  p(info, 'Processed', t, 'files on', len(scheduler.devices), 
+    'device(s).')
 
-      if foundFile:
-        t+=1
-        n+=1
-        filename = file.name
-        filepath = file.path
-        file_extension = filename.split('.')[-1:][0].lower() if \
-                            sys.platform == 'win32' \
-                            else filename.split('.')[-1:][0]
-        p(allmsg,'File:', filename, 'Path:', \
-                         filepath, 'Ext:', file_extension)
-        hashedvalue = hashfile(filepath)
-
-        searchResults = updateSearchResults(file_extension, 1)
-        
-        # get record file_extension
-        ext_ext, ext_action, ext_struct, ext_cat = \
-                getRecord(extlodext, "extension", file_extension)
-        
-        # get_record category
-        cat_cat, cat_cdp, cat_cdc, cat_fbc = \
-                getRecord(extlodext, "category", ext_cat)
-        
-        try:
-          cat_mst, cat_cdp = getRecord(extlodext, "master", cat_cat)
-        except Exception as e:
-          p(critical,'The following warning occured during the category\
-                      search for file', filename, e, 'Defaults will be\
-                      applied (leaveCount, Undefined extensions).')
-          ext_action = "leaveCount"
-          ext_cat = "Undefined extensions"
-          cat_mst = "Anything else"
-          cat_cdp = "filesystem"
-          skip = False
-                  
-        if ext_action == "moveIntoTarget":
-          skip = False
-        elif ext_action == "leaveCount":
-          skip = False
-        
-        if ext_struct == None:
-          p(error,"Structure definition not defined for ", file_extension, \
-                  "not including file in results", filename)
-          skip = False
-          donotInclude = True
-
-        if not skip:
-          try:
-            p(allmsg,'Getting file info', filename)
-            date_taken = getCreationDateInfo(filepath, cat_mst, cat_cdp)
-            skip = True
-
-          except Exception as v:
-            p(error, "Something went wrong. The error is in the data", v)
-
-        if skip:
-          p(allmsg,filename,date_taken)
-
-        if not donotInclude:
-          fileList.append((hashedvalue, 
-                    filepath, 
-                    filename,
-                    date_taken,
-                    ext_struct))
-      else:
-        b+=1
-
-      if n==50:
-        end = time.time() 
-        elapsed_time = round(end - begin, 2)   
-        p(info,'\t\t... checked', t, 'files of', len(filesInFolder), 
-          '('+ str(b),'files skipped), expected another', 
-          round(((elapsed_time/n)*(len(filesInFolder)-t)/60),2), \
-          'minutes.')
-        begin = time.time()
-        n=0
-        if int(settings["number"]) > 0 and int(settings["number"]) <= t:
-          break
-        
+  filled = fileList.fillDates()
+  p(verbose, 'Dated', filled, 'files by their modification time', 
+    '(numpy).' if numpy is not None else '.')
   p(info, 'There are', len(fileList), 'results in the list...')
+  return fileList
+
+#  ********
+#  search, report and check the files
+def performSearch():
+
+  fileList = scanFiles()
+  searchStats.show(info)
   if settings["resultssave"] or settings["action"]:
     p(info,'Saving results due to argument --saveresults (exit) or \
       --action (continue). These might change due to actions.')
-    writeResultsToCsv(deleteSourceFile, now+"_deleteSourceFile.csv")
-    writeResultsToCsv(renameFiles, now+"_renameFiles.csv")
-    writeResultsToCsv(noFolder, now+"_noFolder.csv")
-    writeResultsToCsv(existsButDifferent, now+"_existsButDifferent.csv")
-    writeResultsToCsv(searchResults, now+"_searchResults.csv")
+    searchStats.write(now)
 	
   if settings["foldertarget"]:
     result = checkFiles(fileList)
@@ -869,10 +3995,195 @@ def performSearch():
     p(info, 'Use the argument --target to check the file list'\
       ' against files in that folder structure.')
   
-  p(allmsg, 'Here are the counts', searchResults)
+  p(allmsg, 'Here are the counts', searchStats.counts("extension"))
   # todo, something about duplicates
   return fileList
 
+#  ********
+#  throughput of a stage of the pipeline
+class PipelineStage:
+
+  def __init__(self, name: str, queue=None):
+    self.name = name
+    self.queue = queue
+    self.count = 0
+    self.failed = 0
+
+  def __str__(self):
+    return self.name + ' ' + str(self.count) + \
+      (' (failed ' + str(self.failed) + ')' if self.failed else '') + \
+      (' (queued ' + str(self.queue.qsize()) + ')' if self.queue else '')
+
+#  ********
+#  overlapped run (--pipeline): walk, extract, check and
+#  act are stages connected by bounded queues, so files
+#  are moved while the search is still running. a full
+#  queue stops the stage before it (backpressure). the 
+#  blocking work runs in threads, the event loop only
+#  passes the files on
+#  > returns FileStore
+async def pipelineRun():
+
+  loop = asyncio.get_running_loop()
+  size = settings["pipeline"]
+  workers = max(1, settings["iothreads"])
+  executor = concurrent.futures.ThreadPoolExecutor(
+                  max_workers=workers + 3,
+                  initializer=runState.set, initargs=(currentState(),))
+  stop = object()
+
+  walked = asyncio.Queue(size)
+  extracted = asyncio.Queue(size)
+  decided = asyncio.Queue(size)
+  stages = [PipelineStage("walk", walked), 
+            PipelineStage("extract", extracted),
+            PipelineStage("check", decided), 
+            PipelineStage("act")]
+
+  fileList = FileStore()
+  plan = {"rename": StoreList(fileList, "target"), 
+          "nofolder": [], 
+          "different": StoreList(fileList, "target"), 
+          "delete": StoreList(fileList, "date"), 
+          "archived": StoreList(fileList, "file")}
+  members = []
+  act = settings["action"]
+
+  async def walk():
+    iterator = TreeWalker(settings["walkthreads"]).walk(walkRoots())
+    limit = int(settings["number"])
+    try:
+      while True:
+        folder = await loop.run_in_executor(executor, next, 
+                                            iterator, None)
+        if folder is None:
+          break
+        for file in folder[1]:
+          if settings["shard"] and not inShard(file.path):
+            continue
+          await walked.put(file)
+          stages[0].count += 1
+          if limit > 0 and stages[0].count >= limit:
+            return
+    finally:
+      await loop.run_in_executor(executor, iterator.close)
+      for i in range(workers):
+        await walked.put(stop)
+
+  async def extract():
+    while True:
+      file = await walked.get()
+      if file is stop:
+        break
+      try:
+        result = await loop.run_in_executor(executor, processFile, file)
+      except Exception as e:
+        p(error, 'Processing', file.path, 'failed with error', e)
+        stages[1].failed += 1
+        continue
+      for record, stats in result or []:
+        searchStats.add(*stats)
+        if record:
+          await extracted.put(record)
+          stages[1].count += 1
+
+  async def check():
+    missingFolders = set()
+    running = True
+    while running:
+      # the records at hand are taken (and dated by 
+      # mtime, see fillDates) at once
+      records = [await extracted.get()]
+      while not extracted.empty():
+        records.append(extracted.get_nowait())
+      if records[-1] is stop:
+        running = False
+        records.pop()
+      for record in dateRecords(records):
+        row = fileList.append(record)
+        if not settings["foldertarget"]:
+          continue
+        status, target_dir = await loop.run_in_executor(executor, 
+                              checkRow, row, fileList, plan["archived"])
+        stages[2].count += 1
+        if status == "same":
+          plan["delete"].append(row, target_dir, 
+                    targetStat(target_dir, fileList.name(row)))
+          await decided.put(("delete", 
+                             plan["delete"].item(len(plan["delete"])-1)))
+        elif status == "different":
+          plan["different"].append(row, target_dir)
+        elif status in ("rename", "nofolder"):
+          if status == "nofolder" and target_dir not in missingFolders:
+            missingFolders.add(target_dir)
+            plan["nofolder"].append((target_dir,))
+            await decided.put(("mkdir", (target_dir,)))
+          plan["rename"].append(row, target_dir)
+          await decided.put(("rename", 
+                             plan["rename"].item(len(plan["rename"])-1)))
+    await decided.put((stop, None))
+
+  def perform(action, item):
+    if action == "mkdir":
+      if settings["foldercreate"]:
+        doDirCreate([item])
+    elif action == "rename":
+      if settings["sourcerename"] or settings["link"]:
+        if splitArchivePath(item[0]):
+          # written per archive at the end
+          members.append(item)
+        elif settings["link"]:
+          linkTheFile(item)
+        else:
+          renameTheFile(item)
+    elif action == "delete":
+      if settings["sourcedelete"]:
+        deleteFile(item)
+
+  async def perform_all():
+    while True:
+      action, item = await decided.get()
+      if action is stop:
+        break
+      if act:
+        await loop.run_in_executor(executor, perform, action, item)
+      stages[3].count += 1
+
+  async def report():
+    begin = time.monotonic()
+    while True:
+      await asyncio.sleep(10)
+      p(info, '\t\t... after', round(time.monotonic() - begin), 
+        'seconds:', ', '.join(str(stage) for stage in stages))
+
+  async def scan():
+    await asyncio.gather(walk(), 
+                         *[extract() for i in range(workers)])
+    await extracted.put(stop)
+
+  begin = time.monotonic()
+  reporter = asyncio.ensure_future(report())
+  try:
+    await asyncio.gather(scan(), check(), perform_all())
+  finally:
+    reporter.cancel()
+    executor.shutdown(wait=True)
+
+  p(info, 'Pipeline finished in', round(time.monotonic() - begin, 2), 
+    'seconds:', ', '.join(stage.name + ' ' + str(stage.count) + 
+                          (' (failed ' + str(stage.failed) + ')' 
+                           if stage.failed else '')
+                          for stage in stages))
+  if act and members:
+    p(info, 'Writing', len(members), 'members of archives.')
+    renameTheFiles(members)
+
+  p(info, 'There are', len(fileList), 'results in the list...')
+  searchStats.show(info)
+  if settings["foldertarget"]:
+    reportPlan(plan)
+  return fileList
+
 #  ********
 #  iterate through list until key is found
 #  (the learning process in clear blue light)
@@ -1055,47 +4366,281 @@ def initializeJson(jsonfile):
     p(critical,'No extensions control file found or json error. \
           We can\'t work like this. The error is in the message\n',
           e)
-    raise SystemError(1)
+    raise Mf2fsError('no extensions control file ' + str(jsonfile))
 
   if len(jsonextensions)==0:
     p(critical,'No possible extensions found in the file. \
-          So nothing to do, program halted.',
-          e)
-    raise SystemError(1)
+          So nothing to do, program halted.')
+    raise Mf2fsError('no extensions in ' + str(jsonfile))
 
   fileextensions = dictor(jsonextensions, 'fileextensions')
   categories = dictor(jsonextensions, 'categorylist')
   
   return fileextensions, categories
 
+extlodext = StateProxy("extlodext")
+catlst = StateProxy("catlst")
+
 #  ********
-#  update results of number of found files 
-#  based on extension. this list is saved to csv.
-def updateSearchResults(extension, ext_found):
-  
-  global searchResults
-  found = False
-  
-  if not searchResults:
-    searchResults.append([extension, ext_found])
-  else:
-    for x, value in enumerate(searchResults):
-      if value[0] == extension:
-        value[1] += ext_found
-        found = True
+#  statistics of the found files, files and bytes per
+#  extension, category, action, date source (per
+#  category too) and size class. O(1) per file and
+#  plain dicts, so results of other processes (or
+#  shards) merge by adding the counters. saved as
+#  _statistics.csv, the counts per extension as
+#  _searchResults.csv
+class SearchStats:
+
+  # upper bounds of the size classes
+  sizeClasses = [(1024, '<1K'), (16*1024, '<16K'), (256*1024, '<256K'),
+                 (1024**2, '<1M'), (16*1024**2, '<16M'), 
+                 (256*1024**2, '<256M'), (1024**3, '<1G')]
+
+  def __init__(self):
+    # kind > key > [files, bytes]
+    self.data = {}
+
+  def bump(self, kind, key, files=1, size=0):
+    counters = self.data.setdefault(kind, {})
+    try:
+      counter = counters[key]
+    except KeyError:
+      counter = counters[key] = [0, 0]
+    counter[0] += files
+    counter[1] += size
+
+  #  ********
+  #  > returns the size class of a size
+  def sizeClass(self, size) -> str:
+    if size is None:
+      return 'unknown'
+    for bound, name in self.sizeClasses:
+      if size < bound:
+        return name
+    return '>=1G'
+
+  #  ********
+  #  count one file
+  def add(self, extension, category=None, action=None, size=None,
+          source=None):
+
+    nbytes = size or 0
+    self.bump("extension", extension, 1, nbytes)
+    self.bump("category", str(category), 1, nbytes)
+    self.bump("action", str(action), 1, nbytes)
+    self.bump("datesource", str(source), 1, nbytes)
+    self.bump("categorydatesource", str(category)+'/'+str(source),
+              1, nbytes)
+    self.bump("size", self.sizeClass(size), 1, nbytes)
+
+  def merge(self, other):
+    for kind, counters in other.data.items():
+      for key, counter in counters.items():
+        self.bump(kind, key, counter[0], counter[1])
+    return self
+
+  #  ********
+  #  > returns list of [key, files] of a kind
+  def counts(self, kind) -> list:
+    return [[key, counter[0]] for key, counter in 
+            self.data.get(kind, {}).items()]
+
+  def rows(self) -> list:
+    return [(kind, key, counter[0], counter[1]) 
+            for kind, counters in self.data.items()
+            for key, counter in sorted(counters.items(), 
+                                       key=lambda x: -x[1][0])]
+
+  def write(self, prefix) -> bool:
+    return writeResultsToCsv(self.counts("extension"), 
+                             prefix+"_searchResults.csv") and \
+           writeResultsToCsv(self.rows(), prefix+"_statistics.csv")
+
+  #  ********
+  #  load saved statistics, older result sets only
+  #  have the counts per extension
+  def load(self, prefix) -> bool:
+
+    if os.path.isfile(prefix+"_statistics.csv"):
+      for row in loadResultsFromCsv(prefix+"_statistics.csv") or []:
+        self.bump(row[0], row[1], int(row[2]), int(row[3]))
+      return True
+
+    if os.path.isfile(prefix+"_searchResults.csv"):
+      for row in loadResultsFromCsv(prefix+"_searchResults.csv") or []:
+        self.bump("extension", row[0], int(row[1]))
+      return True
+
+    return False
+
+  #  ********
+  #  summary to screen
+  def show(self, level):
+    for kind in ("category", "action", "datesource"):
+      p(level, 'Files (MB) per', kind+':', ', '.join(
+        str(key)+' '+str(counter[0])+' ('+
+        str(round(counter[1]/1024**2, 1))+')' for key, counter in 
+        sorted(self.data.get(kind, {}).items(), 
+               key=lambda x: -x[1][0])))
+
+searchStats = StateProxy("searchStats")
+
+#  ********
+#  are the contents of two files the same (all bytes)
+def sameContents(source: str, target: str) -> bool:
+
+  try:
+    begin = time.monotonic()
+    total = 0
+    with dirfds.open(source) as a, dirfds.open(target) as b:
+      while True:
+        chunk = a.read(1024*1024)
+        if chunk != b.read(len(chunk) or 1):
+          return False
+        if not chunk:
+          break
+        total += len(chunk)
+    ioDone(source, total, begin)
+    ioDone(target, total)
+    return True
+  except OSError as e:
+    p(warning, 'Comparing', source, 'with', target, 'failed, error', e)
+    return False
+
+#  ********
+#  revalidate one operation of a saved plan, the
+#  source is only hashed again when its signature 
+#  (size, mtime_ns, inode) changed
+#  kind = "rename" > row (source, target, signature)
+#  kind = "delete" > row (source, date, signature, target,
+#                         target size, target mtime_ns, hash)
+#  > returns (status, row), status "ok" is still valid
+def revalidateRow(row, kind):
+
+  if len(row) < 6:
+    return "nosignature", row
+
+  source = row[0]
+  member = splitArchivePath(source)
+  try:
+    st = dirfds.stat(member[0] if member else source)
+  except OSError:
+    return "sourcemissing", row
+
+  try:
+    size, mtime, inode = (int(x) if x else None for x in row[2:5])
+  except ValueError:
+    return "nosignature", row
+  hashedvalue = row[5]
+
+  # members of archives are checked when written
+  if not member and \
+     (st.st_size, st.st_mtime_ns, st.st_ino) != (size, mtime, inode):
+    if st.st_size != size or hashfile(source) != hashedvalue:
+      return "sourcechanged", row
+
+  if kind == "rename":
+    target = row[1]
+    try:
+      tst = dirfds.stat(target)
+    except OSError:
+      return "ok", row
+    # a duplicate becomes a delete candidate, so the
+    # whole contents must be the same
+    if tst.st_size == size and \
+       (catalog.add(target, st=tst) if catalog 
+          else hashfile(target)) == hashedvalue and \
+       not member and sameContents(source, target):
+      return "duplicate", row
+    return "targetexists", row
+
+  target = row[6] if len(row) > 6 else None
+  if not target:
+    return "nosignature", row
+  try:
+    tst = dirfds.stat(target)
+  except OSError:
+    return "targetmissing", row
+  if tst.st_size != size:
+    return "targetchanged", row
+
+  try:
+    tsignature = (int(row[7]), int(row[8]))
+  except (IndexError, ValueError):
+    # a plan without the signature of the target
+    tsignature = None
+  if tsignature != (tst.st_size, tst.st_mtime_ns):
+    # the target changed after the plan was made, the
+    # source is only deleted when it is still the same
+    thash = catalog.add(target, st=tst) if catalog else hashfile(target)
+    if thash != hashedvalue or not sameContents(source, target):
+      return "targetchanged", row
+  elif catalog and catalog.add(target, st=tst) != hashedvalue:
+    return "targetchanged", row
+  return "ok", row
+
+#  ********
+#  revalidate a saved plan, stat (and hash) in 
+#  parallel batches while the plan is read, a window 
+#  of batches at a time. operations no longer valid 
+#  are dropped (appended to stale with their status),
+#  renames of which the same file now exists in the
+#  target are added to duplicates (delete candidates)
+#  > yields the valid rows
+def revalidatePlan(rows, kind, stale, duplicates=None):
+
+  batchsize = 256
+  workers = max(4, 4*settings["iothreads"])
+  rows = iter(rows)
+
+  def check(batch):
+    return [revalidateRow(row, kind) for row in batch]
+
+  def submit(executor):
+    futures = []
+    for i in range(workers):
+      batch = list(itertools.islice(rows, batchsize))
+      if not batch:
         break
-  
-    if not found:
-      searchResults.append([extension, ext_found])
-    
-  return searchResults
-  
+      futures.append(executor.submit(check, batch))
+    return futures
+
+  total = 0
+  counts = {}
+  with concurrent.futures.ThreadPoolExecutor(
+         max_workers=workers,
+         initializer=runState.set, 
+         initargs=(currentState(),)) as executor:
+    # the next window is checked while this one is used
+    pending = submit(executor)
+    while pending:
+      following = submit(executor)
+      for future in pending:
+        for status, row in future.result():
+          total += 1
+          counts[status] = counts.get(status, 0) + 1
+          if status in ("ok", "nosignature"):
+            yield row
+          elif status == "duplicate":
+            if duplicates is not None:
+              duplicates.add(row)
+          else:
+            stale.append((status, kind) + tuple(row))
+      pending = following
+
+  if counts.get("nosignature"):
+    p(warning, counts["nosignature"], 'operations in the', kind, 
+      'plan have no signature (older results) and are not \
+      revalidated.')
+  p(info, 'Revalidated', total, kind, 'operations:', 
+    ', '.join(status+' '+str(n) for status, n in counts.items()))
 
 #  ********
-#  use previously saved results list as input
+#  use previously saved results list as input,
+#  the plan is revalidated while it is executed
 def useResults():
 
-  result = False
+  result = True
   if settings["action"]:
     now = settings["resultsuse"]
     try:
@@ -1108,21 +4653,42 @@ def useResults():
       p(critical,'Something is serious wrong, error', e)
       result = False
 
-    if result == True:
-      try:
-        if settings["sourcerename"]:
-          p(info,'Going to rename files (if any)')
-          csvdata = loadResultsFromCsv(now+"_renameFiles.csv")
-          result=renameTheFiles(csvdata)
-      except Exception as e:
-        p(critical,'Something is serious wrong, error', e)
-        result = False
-
-    if result == True:
-      if settings["sourcedelete"]:
-        p(info,'Going to delete source files (if any)')
-        csvdata = loadResultsFromCsv(now+"_deleteSourceFile.csv") 
-        result=deleteFiles(csvdata)
+    # renames of files already in the target, deleted
+    # with the delete plan (in source path order)
+    duplicates = ExternalSort(lambda row: row[0], settings["sortbuffer"])
+    stale = ResultsWriter(now+"_stale.csv")
+    try:
+      if result == True:
+        try:
+          if settings["sourcerename"] or settings["link"]:
+            p(info,'Going to rename (or link) files (if any)')
+            result=renameTheFiles(
+                      revalidatePlan(
+                        readResultsFromCsv(now+"_renameFiles.csv"),
+                        "rename", stale, duplicates),
+                      linkTheFile if settings["link"] else None)
+        except Exception as e:
+          p(critical,'Something is serious wrong, error', e)
+          result = False
+
+      if result == True:
+        if settings["sourcedelete"]:
+          p(info,'Going to delete source files (if any)')
+          if len(duplicates):
+            p(info, len(duplicates), 'files to rename are already in \
+              the target and are deleted instead.')
+          result=deleteFiles(itertools.chain(
+                    revalidatePlan(
+                      readResultsFromCsv(now+"_deleteSourceFile.csv"),
+                      "delete", stale),
+                    (row for key, row in duplicates)))
+    finally:
+      duplicates.close()
+      stale.close()
+
+    if len(stale):
+      p(info, len(stale), 'stale operations were dropped, see', 
+        now+"_stale.csv")
 
     p(info, 'Finished performing actions with saved csv data \
           from date', now)
@@ -1131,42 +4697,322 @@ def useResults():
     return False
 
 
+#  ********
+#  argparse type for --shard i/N
+def shardArgument(value):
+
+  try:
+    index, count = (int(x) for x in value.split('/'))
+  except ValueError:
+    raise argparse.ArgumentTypeError('use the form i/N, e.g. 2/4')
+
+  if count < 1 or index < 1 or index > count:
+    raise argparse.ArgumentTypeError('shard '+value+' is not \
+      within 1/N and N/N')
+
+  return index, count
+
+#  ********
+#  is the path part of the shard of this run. the
+#  partition only uses the path relative to --input
+#  so it is the same for every process and machine
+#  > returns True|False
+def inShard(path, isdir=False) -> bool:
+
+  if not settings["shard"]:
+    return True
+
+  index, count = settings["shard"]
+  rel = os.path.relpath(os.path.join(path), settings["folderinput"])
+  rel = '' if rel == '.' else rel.replace(os.sep, '/')
+  if sys.platform == 'win32':
+    rel = rel.lower()
+
+  if settings["shardby"] == "subtree":
+    # files directly in --input share the shard of ''
+    parts = rel.split('/')
+    key = parts[0] if isdir or len(parts) > 1 else ''
+  else:
+    key = rel
+
+  return zlib.crc32(key.encode('utf-8', 'surrogateescape')) \
+           % count == index - 1
+
+#  ********
+#  merge the result sets of sharded runs into one 
+#  result set (with the prefix of this run) to be
+#  used with --useresults. a target file planned by
+#  more than one source is a collision, the first
+#  source keeps it and the others are saved in
+#  _targetCollisions.csv instead of being renamed
+def mergeResults(prefixes) -> bool:
+
+  def load(prefix, name):
+    if not os.path.isfile(prefix+name):
+      p(warning, 'Results file', prefix+name, 'not found, skipping.')
+      return []
+    return loadResultsFromCsv(prefix+name) or []
+
+  renameFiles = []
+  noFolder = []
+  existsButDifferent = []
+  deleteSourceFile = []
+  archivedFiles = []
+  searchStats = SearchStats()
+  collisions = []
+  targets = {}
+  sources = set()
+
+  for prefix in prefixes:
+    p(info, 'Merging results with prefix', prefix)
+
+    for row in load(prefix, "_renameFiles.csv"):
+      source, target = row[0], row[1]
+      if source in sources:
+        p(warning, 'Source', source, 'is in more than one shard, \
+          skipping the copy from', prefix)
+        continue
+      if target in targets:
+        p(warning, 'Target', target, 'from', source, '('+prefix+')',
+          'collides with', targets[target][0], 
+          '('+targets[target][1]+')')
+        collisions.append((source, target, prefix, 
+                           targets[target][0], targets[target][1]))
+        continue
+      sources.add(source)
+      targets[target] = (source, prefix)
+      renameFiles.append(tuple(row))
+
+    for row in load(prefix, "_deleteSourceFile.csv"):
+      if row[0] not in sources:
+        sources.add(row[0])
+        deleteSourceFile.append(tuple(row))
+
+    for row in load(prefix, "_existsButDifferent.csv"):
+      existsButDifferent.append(tuple(row))
+
+    for row in load(prefix, "_noFolder.csv"):
+      noFolder.append(tuple(row))
+
+    # only written by shards with a --catalog
+    if os.path.isfile(prefix+"_archivedElsewhere.csv"):
+      for row in load(prefix, "_archivedElsewhere.csv"):
+        archivedFiles.append(tuple(row))
+
+    stats = SearchStats()
+    if stats.load(prefix):
+      searchStats.merge(stats)
+
+  noFolder = removeDuplicates(noFolder)
+  noFolder.sort()
+
+  p(info, 'Merged', len(prefixes), 'result sets into prefix', now)
+  p(info, 'Files that are already present in \
+    target directory:', len(deleteSourceFile))
+  p(info, 'Files that are NOT present in \
+    target directory:', len(renameFiles))
+  p(info, 'Non existing TARGET directories:', len(noFolder))
+  p(info, 'Existing but from source different files (md5 hash) in \
+    TARGET directory:', len(existsButDifferent))
+  p(info, 'Files already archived elsewhere in TARGET \
+    (catalog):', len(archivedFiles))
+  p(info, 'Target collisions between sources:', len(collisions))
+
+  if archivedFiles:
+    writeResultsToCsv(archivedFiles, now+"_archivedElsewhere.csv")
+  writeResultsToCsv(deleteSourceFile, now+"_deleteSourceFile.csv")
+  writeResultsToCsv(renameFiles, now+"_renameFiles.csv")
+  writeResultsToCsv(noFolder, now+"_noFolder.csv")
+  writeResultsToCsv(existsButDifferent, now+"_existsButDifferent.csv")
+  searchStats.write(now)
+  writeResultsToCsv(collisions, now+"_targetCollisions.csv")
+
+  return len(collisions) == 0
+
+#  ********
+#  engine for use from other code (a service), owns 
+#  the state of its runs (RunState): the settings, the
+#  extension tables, the folder patterns, the catalog
+#  and the caches, which stay warm between jobs. the
+#  functions of this script use the state of the 
+#  engine that called them (per thread or task), so 
+#  engines run side by side. errors that stop a run 
+#  raise Mf2fsError
+#
+#    engine = Engine(folderinput="in", foldertarget="out",
+#                    jsonextensions="mf2fs.json")
+#    fileList = engine.scan()
+#    plan = engine.check(fileList)
+#    engine.apply(plan)
+#    engine.close()
+class Engine:
+
+  def __init__(self, options: dict = None, prefix: str = None, 
+               **kwargs):
+
+    settings = get_defaults()
+    settings.update(options or {})
+    settings.update(kwargs)
+    now = prefix or datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    if settings["shard"]:
+      now = now + '_shard%dof%d' % settings["shard"]
+    self.state = RunState(settings, now)
+    self.lock = threading.Lock()
+    self.opened = False
+
+  #  ********
+  #  settings, searchStats, catalog, ... of the state
+  def __getattr__(self, name):
+    if name == "state":
+      raise AttributeError(name)
+    return getattr(self.state, name)
+
+  #  ********
+  #  run with the state of the engine, opened the
+  #  first time
+  @contextlib.contextmanager
+  def bound(self):
+
+    with self.state.bound():
+      with self.lock:
+        if not self.opened:
+          self.open()
+          self.opened = True
+      yield self
+
+  #  ********
+  #  one job (scan, check, apply or run), the caches of
+  #  the file system start empty and the directory fds
+  #  are closed when it is done
+  @contextlib.contextmanager
+  def job(self):
+
+    with self.bound():
+      self.refresh()
+      try:
+        yield self
+      finally:
+        dirfds.reset()
+
+  #  ********
+  #  load the extensions, compile the patterns, open
+  #  the catalog (called bound, once)
+  def open(self):
+
+    state = self.state
+    state.extlodext, state.catlst = \
+                  initializeJson(settings["jsonextensions"])
+    state.extractors = initializeExtractors()
+    state.targetPatterns = initializeFolderPatterns(extlodext)
+    state.dirfds = initializeDirFds()
+    state.catalog = initializeCatalog()
+    state.throttle = initializeThrottle()
+    if settings["ioidle"]:
+      setIdlePriority()
+    p(info, 'Initialization compleet, there are', len(extlodext), 
+      'extensions installed, categorized in', len(catlst), 
+      'categories.')
+
+  #  ********
+  #  forget what is cached of the file system (existence
+  #  of target folders, devices, links) and of the 
+  #  extensions, the trees change between jobs
+  def refresh(self):
+    for pattern in self.state.targetPatterns.values():
+      pattern.exists.clear()
+    self.state.folderDevices.clear()
+    self.state.linkedFiles.clear()
+    self.state.extensionClasses.clear()
+    self.state.memberDigests.clear()
+
+  #  ********
+  #  > returns FileStore of the files found, the 
+  #    statistics are in engine.searchStats
+  def scan(self) -> FileStore:
+    with self.job():
+      self.state.searchStats = SearchStats()
+      return scanFiles()
+
+  #  ********
+  #  > returns the plan, see planFiles
+  def check(self, fileList: FileStore) -> dict:
+    with self.job():
+      return planFiles(fileList)
+
+  #  ********
+  #  perform the plan (-c, -r and -d settings)
+  def apply(self, plan: dict):
+    with self.job():
+      applyPlan(plan)
+
+  #  ********
+  #  a run as from the command line
+  def run(self):
+    with self.job():
+      if settings["estimate"]:
+        return estimateRun()
+      if settings["resultsuse"] and not useResults():
+        return None
+      if settings["pipeline"]:
+        return asyncio.run(pipelineRun())
+      return performSearch()
+
+  #  ********
+  #  async versions, the work runs in a thread
+  async def scanAsync(self) -> FileStore:
+    return await asyncio.get_running_loop().run_in_executor(
+                    None, self.scan)
+
+  async def checkAsync(self, fileList: FileStore) -> dict:
+    return await asyncio.get_running_loop().run_in_executor(
+                    None, self.check, fileList)
+
+  async def applyAsync(self, plan: dict):
+    return await asyncio.get_running_loop().run_in_executor(
+                    None, self.apply, plan)
+
+  async def runAsync(self):
+    return await asyncio.get_running_loop().run_in_executor(
+                    None, self.run)
+
+  #  ********
+  #  commit the catalog and close the directories
+  def close(self):
+    with self.state.bound(), self.lock:
+      for extension, extractor, tries, rate, skipped in \
+                                    extractors.skipped():
+        p(verbose, 'Extractor', extractor, 'is skipped for', extension,
+          '(' + str(rate), 'of', tries, 'tries,', skipped, 'skipped)')
+      extractors.save()
+      if isinstance(self.state.dirfds, SimulatedFs):
+        p(info, 'Simulated operations (count, failures):', 
+          ', '.join(operation + ' ' + str(count) + 
+                    (' (' + str(failed) + ')' if failed else '')
+                    for operation, count, failed in 
+                    dirfds.summary()),
+          '- waited', round(dirfds.waited, 2), 'seconds')
+      if catalog:
+        catalog.close()
+        self.state.catalog = None
+      dirfds.close()
+      self.opened = False
+
 #  ********
 #  get started
 if __name__ == "__main__":
 
-  global extext
-  global ext_found
-
-  #  --------
-  #  loglevels CONSTANTS
-  loglevels = ["silent","critical","error","warning",
-          "info","verbose","allmsg"]
-  silent = 0
-  critical = 1
-  error = 2
-  warning = 3
-  info = 4
-  verbose = 5
-  allmsg = 6
-
-  # used as prefix for csv files
-  now = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-  
   initialize()
-  extlodext, catlst = \
-              initializeJson(settings["jsonextensions"])
+  if settings["resultsmerge"]:
+    mergeResults(settings["resultsmerge"])
+    p(info, 'Finished, use --useresults', now, 'to perform actions.')
+    raise SystemExit(0)
 
-  p(info, 'Initialization compleet, there are', len(extlodext), 
-    'extensions installed, categorized in', len(catlst), 'categories.')
-  
-  result = False
-  if settings["resultsuse"]: 
-    result = useResults()
-  else:
-    result = True
-
-  if result:
-    fileList = performSearch()
+  engine = Engine(settings, prefix=str(now))
+  try:
+    engine.run()
+  except Mf2fsError:
+    raise SystemExit(1)
+  finally:
+    engine.close()
 
   p(info,'Finished.')
@@ -0,0 +1,69 @@
+import os
+import sys
+import hashlib
+import tarfile
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mf2fs
+
+JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    "mf2fs.json")
+
+
+def makeEngine(tmp_path):
+  return mf2fs.Engine(folderinput=str(tmp_path), foldertarget=str(tmp_path),
+                      jsonextensions=JSON, loglevel="silent",
+                      prefix=str(tmp_path / "run"))
+
+
+def test_zip_member_with_invalid_date_is_skipped(tmp_path):
+
+  archivepath = str(tmp_path / "photos.zip")
+  with zipfile.ZipFile(archivepath, "w") as archive:
+    # month 13, as written by broken tools
+    archive.writestr(zipfile.ZipInfo("bad.jpg", (2021, 13, 4, 12, 0, 0)), 
+                     b"bad")
+    archive.writestr(zipfile.ZipInfo("good.jpg", (2021, 3, 4, 12, 0, 0)), 
+                     b"good")
+
+  engine = makeEngine(tmp_path)
+  try:
+    with engine.bound():
+      results = mf2fs.indexArchive(archivepath)
+  finally:
+    engine.close()
+
+  names = [record[2] for record, stats in results if record]
+  assert names == ["good.jpg"]
+
+
+def test_tar_members_are_hashed_in_one_pass(tmp_path, monkeypatch):
+
+  archivepath = str(tmp_path / "photos.tar")
+  contents = {}
+  with tarfile.open(archivepath, "w") as archive:
+    for i in range(5):
+      member = tmp_path / ("p%d.jpg" % i)
+      member.write_bytes(b"picture %d" % i)
+      archive.add(str(member), arcname=member.name)
+      contents[member.name] = hashlib.md5(member.read_bytes()).hexdigest()
+
+  opened = []
+  tarOpen = tarfile.open
+  def countingOpen(*args, **kwargs):
+    opened.append(args)
+    return tarOpen(*args, **kwargs)
+  monkeypatch.setattr(tarfile, "open", countingOpen)
+
+  engine = makeEngine(tmp_path)
+  try:
+    with engine.bound():
+      digests = {name: mf2fs.fullHash(archivepath + mf2fs.archiveMarker + 
+                                      '/' + name)
+                 for name in contents}
+  finally:
+    engine.close()
+
+  assert digests == contents
+  assert len(opened) == 1
@@ -0,0 +1,122 @@
+import os
+import sys
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mf2fs
+
+JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    "mf2fs.json")
+
+
+def writePicture(path, contents):
+  path.write_bytes(contents)
+  stamp = datetime.datetime(2021, 3, 4, 12, 0).timestamp()
+  os.utime(path, (stamp, stamp))
+
+
+def test_second_job_sees_folders_of_the_first(tmp_path):
+
+  source = tmp_path / "src"
+  target = tmp_path / "tgt"
+  source.mkdir()
+  target.mkdir()
+  engine = mf2fs.Engine(folderinput=str(source), foldertarget=str(target),
+                        jsonextensions=JSON, foldercreate=True,
+                        sourcerename=True, action=True, loglevel="silent",
+                        prefix=str(tmp_path / "run"))
+  try:
+    writePicture(source / "photo.jpg", b"FIRST")
+    engine.run()
+    archived = [os.path.join(folder, name) for folder, folders, names
+                in os.walk(target) for name in names if name == "photo.jpg"]
+    assert len(archived) == 1
+
+    # the same name with other contents, the target folder
+    # now exists and the archived file must be kept
+    writePicture(source / "photo.jpg", b"SECOND")
+    engine.run()
+  finally:
+    engine.close()
+
+  with open(archived[0], "rb") as photo:
+    assert photo.read() == b"FIRST"
+  assert (source / "photo.jpg").read_bytes() == b"SECOND"
+
+
+def test_replaced_folder_is_reopened(tmp_path):
+
+  dirfds = mf2fs.DirFds(16)
+  folder = tmp_path / "d"
+  try:
+    folder.mkdir()
+    (folder / "a").write_bytes(b"1")
+    assert dirfds.isfile(str(folder / "a"))
+
+    # the cached fd still points to the removed folder
+    (folder / "a").unlink()
+    folder.rmdir()
+    folder.mkdir()
+    (folder / "b").write_bytes(b"2")
+    assert not dirfds.isfile(str(folder / "a"))
+    assert dirfds.isfile(str(folder / "b"))
+  finally:
+    dirfds.close()
+
+
+def test_pipeline_skips_failed_and_undated_files(tmp_path, monkeypatch):
+
+  source = tmp_path / "src"
+  target = tmp_path / "tgt"
+  source.mkdir()
+  target.mkdir()
+  for name in ("good.jpg", "bad.jpg", "nodate.jpg"):
+    writePicture(source / name, name.encode())
+
+  processFile = mf2fs.processFile
+
+  def flaky(file):
+    if file.name == "bad.jpg":
+      raise OSError("simulated")
+    result = processFile(file)
+    if file.name == "nodate.jpg":
+      # no date and no mtime (the stat failed)
+      result = [(record[:3] + (None,) + record[4:8] + (None,) + 
+                 record[9:], stats) for record, stats in result]
+    return result
+
+  monkeypatch.setattr(mf2fs, "processFile", flaky)
+  engine = mf2fs.Engine(folderinput=str(source), foldertarget=str(target),
+                        jsonextensions=JSON, foldercreate=True,
+                        sourcerename=True, action=True, pipeline=8,
+                        loglevel="silent", prefix=str(tmp_path / "run"))
+  try:
+    engine.run()
+  finally:
+    engine.close()
+
+  moved = [name for folder, folders, names in os.walk(target) 
+                for name in names]
+  assert moved == ["good.jpg"]
+  assert (source / "bad.jpg").exists()
+  assert (source / "nodate.jpg").exists()
+
+
+def test_created_folders_forget_their_device(tmp_path):
+
+  target = tmp_path / "tgt"
+  target.mkdir()
+  folder = str(target / "2021" / "03")
+  engine = mf2fs.Engine(folderinput=str(tmp_path), foldertarget=str(target),
+                        jsonextensions=JSON, loglevel="silent",
+                        prefix=str(tmp_path / "run"))
+  try:
+    with engine.bound():
+      # taken from the parent while the folder is missing
+      mf2fs.folderDevice(folder)
+      assert folder in engine.folderDevices
+      mf2fs.doDirCreate([folder])
+      assert folder not in engine.folderDevices
+      assert os.path.isdir(folder)
+  finally:
+    engine.close()
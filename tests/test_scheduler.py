@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mf2fs
+
+
+class TwoDevices(mf2fs.DeviceScheduler):
+
+  # the device is the first part of the name
+  def locate(self, item):
+    return item.split("/")[0], 0
+
+
+def work(item):
+  if item.startswith("slow"):
+    time.sleep(0.05)
+  return item
+
+
+def test_slow_device_does_not_stall_fast_device():
+
+  items = []
+  for i in range(40):
+    items.append("fast/%d" % i)
+    if i % 8 == 0:
+      items.append("slow/%d" % i)
+  scheduler = TwoDevices(1)
+  scheduler.window = 4
+  results = list(scheduler.run(items, work))
+
+  assert sorted(results) == sorted(items)
+  assert scheduler.devices == {"fast", "slow"}
+  # the fast device is not held up at the windows
+  fast = [i for i, item in enumerate(results) if item.startswith("fast")]
+  assert fast[-1] < results.index("slow/32")
+
+
+def test_failed_items_and_early_stop():
+
+  def fail(item):
+    if item.endswith("/3"):
+      raise OSError("simulated")
+    return item
+
+  threads = threading.active_count()
+  results = list(TwoDevices(2).run(["fast/%d" % i for i in range(10)], fail))
+  assert results.count(None) == 1
+  assert len(results) == 10
+
+  run = TwoDevices(2).run(("fast/%d" % i for i in range(100000)), work)
+  next(run)
+  run.close()
+  assert threading.active_count() == threads
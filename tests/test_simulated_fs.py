@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mf2fs
+
+JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    "mf2fs.json")
+
+
+def makeTree(tmp_path):
+  source = tmp_path / "src"
+  target = tmp_path / "tgt"
+  source.mkdir()
+  target.mkdir()
+  picture = source / "a.jpg"
+  picture.write_bytes(b"not really a picture")
+  stamp = datetime.datetime(2021, 3, 4, 12, 0).timestamp()
+  os.utime(picture, (stamp, stamp))
+  return source, target, picture
+
+
+def targetFiles(target):
+  return [os.path.join(folder, name) for folder, folders, names 
+          in os.walk(target) for name in names if name == "a.jpg"]
+
+
+def test_rename_falls_back_to_copy_on_exdev(tmp_path):
+
+  source, target, picture = makeTree(tmp_path)
+  engine = mf2fs.Engine(folderinput=str(source), foldertarget=str(target),
+                        jsonextensions=JSON, foldercreate=True,
+                        sourcerename=True, action=True, loglevel="silent",
+                        simulate="errors=1,errno=EXDEV",
+                        prefix=str(tmp_path / "run"))
+  try:
+    fileList = engine.scan()
+    plan = engine.check(fileList)
+    engine.apply(plan)
+    failures = dict(engine.dirfds.failures)
+  finally:
+    engine.close()
+
+  assert failures.get("rename EXDEV", 0) >= 1
+  copies = targetFiles(target)
+  assert len(copies) == 1
+  with open(copies[0], "rb") as copy:
+    assert copy.read() == b"not really a picture"
+  # copied, not moved (-d is not given)
+  assert picture.exists()
+
+
+def test_simulated_stat_errors_do_not_move_files(tmp_path):
+
+  source, target, picture = makeTree(tmp_path)
+  engine = mf2fs.Engine(folderinput=str(source), foldertarget=str(target),
+                        jsonextensions=JSON, foldercreate=True,
+                        sourcerename=True, action=True, loglevel="silent",
+                        simulate="errors=1,errno=EIO",
+                        prefix=str(tmp_path / "run"))
+  try:
+    engine.run()
+    operations = dict(engine.dirfds.operations)
+  finally:
+    engine.close()
+
+  # the listing fails, nothing is found or touched
+  assert operations.get("scandir", 0) >= 1
+  assert targetFiles(target) == []
+  assert picture.exists()
+
+
+def test_simulated_latency_and_jitter(tmp_path):
+
+  source, target, picture = makeTree(tmp_path)
+  engine = mf2fs.Engine(folderinput=str(source), foldertarget=str(target),
+                        jsonextensions=JSON, loglevel="silent",
+                        simulate="latency=4ms,jitter=2ms,seed=1",
+                        prefix=str(tmp_path / "run"))
+  try:
+    begin = time.monotonic()
+    engine.scan()
+    elapsed = time.monotonic() - begin
+    count = sum(engine.dirfds.operations.values())
+    waited = engine.dirfds.waited
+  finally:
+    engine.close()
+
+  assert engine.dirfds.latency == 0.004
+  assert engine.dirfds.jitter == 0.002
+  assert count >= 2
+  # every operation waits latency +- jitter
+  assert 0.002 * count <= waited <= 0.006 * count
+  assert elapsed >= 0.002 * count
+
+
+def test_iolimit_throttles_the_simulated_fs(tmp_path):
+
+  source, target, picture = makeTree(tmp_path)
+  for i in range(40):
+    (source / ("b%02d.jpg" % i)).write_bytes(b"another")
+  engine = mf2fs.Engine(folderinput=str(source), foldertarget=str(target),
+                        jsonextensions=JSON, loglevel="silent",
+                        simulate="seed=1", iolimit=["ops=20"],
+                        prefix=str(tmp_path / "run"))
+  try:
+    begin = time.monotonic()
+    fileList = engine.scan()
+    elapsed = time.monotonic() - begin
+    files = len(fileList)
+  finally:
+    engine.close()
+
+  assert files == 41
+  # one operation per file at least, 20 of them are free
+  # (the burst) and the others take 1/20 s each
+  assert elapsed >= (files - 20) / 20 * 0.9
@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mf2fs
+
+JSON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    "mf2fs.json")
+
+
+def makeTree(root, depth, width):
+  paths = set()
+  for i in range(width):
+    folder = root / ("f%d" % i)
+    folder.mkdir()
+    picture = folder / ("p%d.jpg" % i)
+    picture.write_bytes(b"x")
+    paths.add(str(picture))
+    if depth > 1:
+      paths |= makeTree(folder, depth - 1, width)
+  return paths
+
+
+def test_concurrent_walk_lists_every_folder_once(tmp_path):
+
+  source = tmp_path / "src"
+  source.mkdir()
+  expected = makeTree(source, 3, 4)
+  engine = mf2fs.Engine(folderinput=str(source), 
+                        foldertarget=str(tmp_path), jsonextensions=JSON,
+                        loglevel="silent", simulate="latency=1ms,seed=1",
+                        prefix=str(tmp_path / "run"))
+  try:
+    with engine.bound():
+      folders = []
+      found = []
+      for folder, files in mf2fs.TreeWalker(8).walk([(str(source), True)]):
+        folders.append(folder)
+        found.extend(entry.path for entry in files)
+  finally:
+    engine.close()
+
+  # the root, 4 + 16 + 64 folders
+  assert len(folders) == 85
+  assert len(set(folders)) == len(folders)
+  assert sorted(found) == sorted(expected)
+
+
+def test_walk_stopped_early_ends_its_threads(tmp_path):
+
+  source = tmp_path / "src"
+  source.mkdir()
+  makeTree(source, 3, 4)
+  engine = mf2fs.Engine(folderinput=str(source), 
+                        foldertarget=str(tmp_path), jsonextensions=JSON,
+                        loglevel="silent", prefix=str(tmp_path / "run"))
+  threads = threading.active_count()
+  try:
+    with engine.bound():
+      walk = mf2fs.TreeWalker(8).walk([(str(source), True)])
+      next(walk)
+      walk.close()
+  finally:
+    engine.close()
+
+  assert threading.active_count() == threads